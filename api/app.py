@@ -1,10 +1,21 @@
-import mlflow 
+import os
 import uvicorn
 import json
-import pandas as pd 
-from pydantic import BaseModel
-from typing import Literal, List, Union
-from fastapi import FastAPI, File, UploadFile
+import numpy as np
+from pydantic import BaseModel, StrictFloat, StrictInt
+from typing import Dict, Literal, List, Optional, Union
+from fastapi import FastAPI, File, UploadFile, Query, Request, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from itertools import chain
+from io_formats import STREAMING_MEDIA_TYPES, detect_format, format_predictions, format_supported, read_chunks, score_chunks
+from batcher import PredictionBatcher
+from executors import BoundedExecutor, Overloaded
+from grid import PriceGrid, axis_values
+from jobs import JobManager
+from metrics import TimedModel, TimedRoute, profile_request, register_stats, render, set_model_info, stage, timed_chunks
+from model_registry import ModelRegistry
+from prediction_cache import cache_key, make_cache
 
 description = """
 API for Getaround predictions : this application may allow you to have an estimation on the rental price per day of your car, just by giving the applications some features regarding your car. 
@@ -13,7 +24,24 @@ API for Getaround predictions : this application may allow you to have an estima
 
 Where you can:
 * `/predict` the rental price of the car
-* `/batch-predict` where you can upload a file to get prediction for the car
+* `/batch-predict` where you can upload a file to get prediction for the car (streamed back as csv / ndjson for large files)
+* `/predict-grid` the rental price of one car across ranges of mileage, engine power, fuel...
+
+## Jobs
+
+For files too large to be scored within one request:
+* `/jobs` submits a file and returns a job id
+* `/jobs/{job_id}` gives the status of the job (rows done so far)
+* `/jobs/{job_id}/results` downloads the predictions once the job is done
+
+## Model
+
+* `/model` tells which version of the model is currently served
+
+## Monitoring
+
+* `/stats` gives the micro-batching and cache metrics of `/predict`
+* `/metrics` exports the metrics (latency by stage, requests, rows scored, model version) for Prometheus
 
 
 Check out documentation for more information on each endpoint. 
@@ -27,6 +55,18 @@ tags_metadata = [
     {
         "name": "Predictions",
         "description": "Endpoints that uses our Machine Learning model for predicting rental price per day."
+    },
+    {
+        "name": "Jobs",
+        "description": "Batch predictions run in the background."
+    },
+    {
+        "name": "Model",
+        "description": "Information about the model currently served."
+    },
+    {
+        "name": "Monitoring",
+        "description": "Metrics of the API."
     }
 ]
 
@@ -40,6 +80,97 @@ app = FastAPI(
     openapi_tags=tags_metadata
 )
 
+# Requests are timed by stage and exported on /metrics, see metrics.py
+app.router.route_class = TimedRoute
+app.middleware("http")(profile_request)
+
+# Model is loaded once per worker (or once in the gunicorn master, see gunicorn.conf.py) and hot
+# swapped when a new version gets registered
+# (slim serving: MODEL_PATH points at a compiled .npz table, served without mlflow / sklearn / pandas)
+registry = ModelRegistry(
+    model_name=os.environ.get("MODEL_NAME", "api_linear_regression"),
+    default_uri=os.environ.get("MODEL_URI", "runs:/1ba78b657fc4426c8bec1a2731fecab7/getaround_project"),
+    poll_interval=float(os.environ.get("MODEL_POLL_INTERVAL", 60)),
+    local_path=os.environ.get("MODEL_PATH")
+)
+registry.listeners.append(set_model_info)
+
+# CPU bound work runs off the event loop, in separate pools so that single predictions
+# never wait behind batch files. A full pool answers 503 with a Retry-After header.
+interactive_pool = BoundedExecutor(
+    "interactive",
+    max_workers=int(os.environ.get("INTERACTIVE_POOL_WORKERS", 2)),
+    max_queue=int(os.environ.get("INTERACTIVE_POOL_QUEUE", 32))
+)
+batch_pool = BoundedExecutor(
+    "batch",
+    max_workers=int(os.environ.get("BATCH_POOL_WORKERS", 2)),
+    max_queue=int(os.environ.get("BATCH_POOL_QUEUE", 4))
+)
+RETRY_AFTER = os.environ.get("RETRY_AFTER", "1")
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Too many requests in progress ({exc.pool} predictions), retry later"},
+        headers={"Retry-After": RETRY_AFTER}
+    )
+
+# Concurrent /predict calls are scored together in one vectorized call
+batcher = PredictionBatcher(
+    lambda records: registry.model.predict_records(records),
+    max_batch_size=int(os.environ.get("BATCH_MAX_SIZE", 64)),
+    max_wait_ms=float(os.environ.get("BATCH_MAX_WAIT_MS", 2)),
+    executor=interactive_pool
+)
+
+# Results of /predict for the features already seen with the live model
+prediction_cache = make_cache(
+    backend=os.environ.get("PREDICTION_CACHE_BACKEND", "memory"),
+    max_size=int(os.environ.get("PREDICTION_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("PREDICTION_CACHE_TTL", 3600)),
+    path=os.environ.get("PREDICTION_CACHE_PATH", "/dev/shm/getaround_predictions.sqlite"),
+    timeout=float(os.environ.get("PREDICTION_CACHE_TIMEOUT", 0.05))
+)
+if prediction_cache is not None:
+    registry.listeners.append(lambda live: prediction_cache.clear())
+
+
+async def cache_call(method, *args):
+    # The sqlite backend can wait on another worker's lock: off the event loop
+    if prediction_cache.blocking:
+        return await run_in_threadpool(method, *args)
+    return method(*args)
+
+# Large files are scored in the background, inputs / results are kept in the spool directory
+jobs = JobManager(
+    spool_dir=os.environ.get("JOB_SPOOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs")),
+    get_model=lambda: registry.model,
+    max_concurrent=int(os.environ.get("JOBS_MAX_CONCURRENT", 1)),
+    max_queued=int(os.environ.get("JOBS_MAX_QUEUED", 100))
+)
+
+# With gunicorn's preload_app the model is loaded here, in the master, and shared copy-on-write by
+# the workers forked afterwards. Threads (polling, batcher, jobs) are only started in the workers.
+if os.environ.get("PRELOAD_MODEL") == "1":
+    registry.load()
+
+@app.on_event("startup")
+async def load_model():
+    # Loads the model unless it was preloaded
+    registry.start()
+    await batcher.start()
+    jobs.start()
+
+@app.on_event("shutdown")
+async def stop_model_polling():
+    await batcher.stop()
+    jobs.stop()
+    registry.stop()
+    interactive_pool.shutdown()
+    batch_pool.shutdown()
+
 class PredictionFeatures(BaseModel):
     model_key: Literal['Citroën', 'Peugeot', 'PGO', 'Renault', 'Audi', 'BMW', 'Ford', 'Mercedes', 'Opel', 'Porsche', 'Volkswagen', 'KIA Motors', 'Alfa Romeo', 'Ferrari', 'Fiat', 'Lamborghini', 'Maserati', 'Lexus', 'Honda', 'Mazda', 'Mini', 'Mitsubishi', 'Nissan', 'SEAT', 'Subaru', 'Suzuki', 'Toyota', 'Yamaha'] = "Citroën"
     mileage: Union[int, float] = 0
@@ -56,6 +187,24 @@ class PredictionFeatures(BaseModel):
     winter_tires : Literal["yes", "no"] = "no"
 
 
+class GridAxis(BaseModel):
+    # Strict: pydantic would otherwise take true / false for 1 / 0
+    values: Optional[List[Union[StrictInt, StrictFloat, str]]] = None
+    start: Optional[StrictFloat] = None
+    stop: Optional[StrictFloat] = None
+    step: Optional[StrictFloat] = None
+
+
+class GridRequest(BaseModel):
+    base: PredictionFeatures = PredictionFeatures()
+    sweep: Dict[str, GridAxis]
+
+
+# Largest grid accepted by /predict-grid, and size from which results are streamed
+GRID_MAX_SIZE = int(os.environ.get("GRID_MAX_SIZE", 1000000))
+GRID_STREAM_THRESHOLD = int(os.environ.get("GRID_STREAM_THRESHOLD", 10000))
+
+
 @app.get("/", tags=["Introduction"])
 async def index():
     message = "Welcome! This `/` is the most simple and default endpoint. If you want to have an estimation of the daily rental price of your car, check out documentation of the api at `/docs`"
@@ -91,38 +240,233 @@ async def predict(predictionFeatures: PredictionFeatures):
     - winter_tires
     ```
     """
-    # Read data 
-    df = pd.DataFrame(dict(predictionFeatures), index=[0])
+    features = dict(predictionFeatures)
 
-    # Log model from mlflow 
-    logged_model = 'runs:/1ba78b657fc4426c8bec1a2731fecab7/getaround_project'
+    # Same car already quoted by the live model
+    with stage("model_lookup"):
+        key = cache_key(features, registry.live.uri) if prediction_cache is not None else None
+        prediction = await cache_call(prediction_cache.get, key) if key is not None else None
 
-    # Load model as a PyFuncModel.
-    loaded_model = mlflow.pyfunc.load_model(logged_model)
-    prediction = loaded_model.predict(df)
+    if prediction is None:
+        # Scored along with the other pending requests, straight from the features (no DataFrame)
+        # when the model is compiled, see batcher.py and scorer.py
+        with stage("predict"):
+            prediction = await batcher.predict(features)
+        if key is not None:
+            await cache_call(prediction_cache.set, key, float(prediction))
 
     # Format response
-    response = {"prediction": f"{round(prediction.tolist()[0])} euros"}
+    response = {"prediction": f"{round(float(prediction))} euros"}
     return response
 
 
 @app.post("/batch-predict", tags=["Predictions"])
-async def batch_predict(file: UploadFile = File(...)):
+async def batch_predict(
+    file: UploadFile = File(...),
+    output: Literal["json", "csv", "ndjson", "parquet", "arrow"] = "json",
+    chunksize: int = Query(10000, gt=0, le=1000000)
+):
     """
-    Make prediction on a batch of observation. This endpoint accepts only **csv files** containing 
-    all the trained columns WITHOUT the target variable. 
+    Make prediction on a batch of observation. This endpoint accepts **csv, Parquet or Arrow IPC files** containing 
+    all the trained columns WITHOUT the target variable. The format is read from the content type
+    of the file (`text/csv`, `application/vnd.apache.parquet`, `application/vnd.apache.arrow.file`,
+    `application/vnd.apache.arrow.stream`), or from its extension (`.csv`, `.parquet`, `.arrow`, `.arrows`).
+
+    By default the predictions are returned as one JSON list. For large files, ask for
+    `output=csv`, `output=ndjson`, `output=parquet` or `output=arrow` (Arrow IPC stream): the file is then
+    read and scored `chunksize` rows at a time and the predictions are streamed back as they are
+    computed, with the index of their row:
+    ```
+    row,prediction              {"row": 0, "prediction": 123.4}
+    0,123.4                     {"row": 1, "prediction": 98.7}
+    ```
     """
-    # Read file 
-    df = pd.read_csv(file.file)
+    # Model loaded at startup, the same one is used for the whole file
+    with stage("model_lookup"):
+        loaded_model = TimedModel(registry.model, "/batch-predict")
+
+    # Read file chunk by chunk
+    input_format = detect_format(file.content_type, file.filename)
+    if not format_supported(input_format):
+        raise HTTPException(status_code=415, detail=f"{input_format} files need pyarrow, which isn't installed")
+    chunks = timed_chunks(read_chunks(file.file, input_format, chunksize), "/batch-predict")
+
+    if output in STREAMING_MEDIA_TYPES:
+        # The stream holds one slot of the batch pool until it ends (503 when there is none left).
+        # The first chunk is read and scored before the response starts, so a malformed file or
+        # one missing trained columns is refused with a 422 instead of cutting the stream short.
+        # Next chunks are read and scored in the pool too.
+        release = batch_pool.admit()
+        scored = score_chunks(loaded_model, chunks)
+        try:
+            first = await batch_pool.run(next, scored, None, admit=False)
+        except Exception as e:
+            release()
+            raise HTTPException(status_code=422, detail=f"Could not score the file: {e!r}")
+        except BaseException:
+            release()
+            raise
+        scored = chain([first], scored) if first is not None else iter([])
+        return StreamingResponse(
+            batch_pool.iterate(format_predictions(scored, output), release),
+            media_type=STREAMING_MEDIA_TYPES[output]
+        )
+
+    def score_file():
+        predictions = [loaded_model.predict(chunk) for chunk in chunks]
+        return np.concatenate(predictions).tolist() if predictions else []
 
-    # Log model from mlflow 
-    logged_model = 'runs:/1ba78b657fc4426c8bec1a2731fecab7/getaround_project'
+    return await batch_pool.run(score_file)
 
-    # Load model as a PyFuncModel.
-    loaded_model = mlflow.pyfunc.load_model(logged_model)
-    predictions = loaded_model.predict(df)
 
-    return predictions.tolist()
+@app.post("/predict-grid", tags=["Predictions"])
+async def predict_grid(gridRequest: GridRequest):
+    """
+    Prices of one car (`base`, same fields as `/predict`) for every combination of the values
+    given in `sweep`, scored in one go. Each swept field takes either a list of `values` or a
+    range from `start` to `stop` (included) by `step`:
+    ```
+    {
+        "base": {"model_key": "Renault", "engine_power": 110, "fuel": "diesel", ...},
+        "sweep": {
+            "mileage": {"start": 0, "stop": 300000, "step": 10000},
+            "fuel": {"values": ["diesel", "petrol", "hybrid_petrol", "electro"]}
+        }
+    }
+    ```
+    Returns one object per point of the grid with the swept fields and the prediction:
+    `[{"mileage": 0.0, "fuel": "diesel", "prediction": 123.4}, ...]`. Grids larger than
+    `GRID_STREAM_THRESHOLD` points are streamed back as ndjson (one object per line),
+    grids larger than `GRID_MAX_SIZE` points are refused.
+    """
+    base = dict(gridRequest.base)
+    axes = {}
+    for name, axis in gridRequest.sweep.items():
+        if name not in base:
+            raise HTTPException(status_code=422, detail=f"Unknown field {name}")
+        try:
+            values = axis_values(axis.values, axis.start, axis.stop, axis.step, max_values=GRID_MAX_SIZE)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"{name}: {e}")
+        if isinstance(base[name], str):
+            # Same checks as /predict for the text fields
+            for value in values:
+                try:
+                    PredictionFeatures(**{**base, name: value})
+                except ValueError:
+                    raise HTTPException(status_code=422, detail=f"{name}: invalid value {value!r}")
+        elif not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            raise HTTPException(status_code=422, detail=f"{name}: values must be numbers")
+        axes[name] = values
+
+    grid = PriceGrid(base, axes)
+    if grid.size > GRID_MAX_SIZE:
+        raise HTTPException(status_code=422, detail=f"Grid has {grid.size} points, at most {GRID_MAX_SIZE} are allowed")
+
+    with stage("model_lookup"):
+        loaded_model = TimedModel(registry.model, "/predict-grid")
+
+    def score(frame):
+        return frame[grid.fields].assign(prediction=loaded_model.predict(frame))
+
+    if grid.size <= GRID_STREAM_THRESHOLD:
+        result = await interactive_pool.run(lambda: score(grid.frame(0, grid.size)).to_json(orient="records"))
+        return Response(content=result, media_type="application/json")
+
+    # Large grids are built, scored and sent chunk by chunk
+    texts = (score(frame).to_json(orient="records", lines=True).rstrip("\n") + "\n" for frame in grid.frames(GRID_STREAM_THRESHOLD))
+    release = batch_pool.admit()
+    try:
+        first = await batch_pool.run(next, texts, admit=False)
+    except BaseException:
+        release()
+        raise
+    return StreamingResponse(batch_pool.iterate(chain([first], texts), release), media_type="application/x-ndjson")
+
+
+@app.post("/jobs", tags=["Jobs"], status_code=202)
+async def submit_job(file: UploadFile = File(...)):
+    """
+    Submit a file (same formats as `/batch-predict`) to be scored in the background. Returns the
+    status of the job, poll `/jobs/{job_id}` until its status is `done` then download the predictions.
+    """
+    input_format = detect_format(file.content_type, file.filename)
+    if not format_supported(input_format):
+        raise HTTPException(status_code=415, detail=f"{input_format} files need pyarrow, which isn't installed")
+    # Copying the upload to the spool is blocking I/O
+    return await run_in_threadpool(jobs.submit, file.file, file.filename, file.content_type)
+
+
+@app.get("/jobs/{job_id}", tags=["Jobs"])
+async def job_status(job_id: str):
+    """
+    Status of a job: `queued`, `running`, `done` or `failed`, with the number of rows scored so far (`rows_done`).
+    """
+    status = jobs.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+
+@app.get("/jobs/{job_id}/results", tags=["Jobs"])
+async def job_results(job_id: str):
+    """
+    Predictions of a finished job, as a csv file with one line `row,prediction` per row of the input.
+    """
+    status = jobs.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if status["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {status['status']}")
+    return FileResponse(jobs.result_path(job_id), media_type="text/csv", filename=f"{job_id}.csv")
+
+
+@app.get("/model", tags=["Model"])
+async def model_info():
+    """
+    Model currently served by this worker. `version` is null when serving the default run
+    (the model registry couldn't be reached at startup).
+    """
+    live = registry.live
+    if live is None:
+        return {"name": registry.model_name, "version": None, "uri": None, "loaded_at": None}
+    return {"name": live.name, "version": live.version, "uri": live.uri, "loaded_at": live.loaded_at}
+
+
+def collect_stats():
+    return {
+        "batching": batcher.stats(),
+        "cache": prediction_cache.stats() if prediction_cache is not None else None,
+        "pools": {"interactive": interactive_pool.stats(), "batch": batch_pool.stats()}
+    }
+
+stats_collector = register_stats(collect_stats)
+
+
+@app.get("/stats", tags=["Monitoring"])
+async def stats():
+    """
+    Micro-batching of `/predict`: number and size of the batches, time spent waiting in the queue.
+    Tune with the `BATCH_MAX_SIZE` and `BATCH_MAX_WAIT_MS` environment variables.
+
+    Worker pools: tasks pending and refused (503) in the `interactive` (`/predict`) and `batch` pools,
+    sized with `INTERACTIVE_POOL_WORKERS` / `INTERACTIVE_POOL_QUEUE` and `BATCH_POOL_WORKERS` / `BATCH_POOL_QUEUE`.
+
+    Prediction cache: hits, misses, evictions. Set up with `PREDICTION_CACHE_BACKEND` (`memory`,
+    `sqlite` to share it between workers, `none`), `PREDICTION_CACHE_SIZE`, `PREDICTION_CACHE_TTL`
+    (seconds) and `PREDICTION_CACHE_PATH` (sqlite file).
+    """
+    return collect_stats()
+
+
+@app.get("/metrics", tags=["Monitoring"])
+async def metrics():
+    """
+    Metrics in the Prometheus text format: requests, in-flight requests, latency of each stage
+    (`validation`, `dataframe`, `model_lookup`, `predict`, `serialization`), rows per batch, model version.
+    """
+    body, content_type = render([stats_collector])
+    return Response(content=body, media_type=content_type)
 
 if __name__=="__main__":
     uvicorn.run(app, host="0.0.0.0", port=4000, debug=True, reload=True)
\ No newline at end of file
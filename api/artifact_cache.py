@@ -0,0 +1,178 @@
+"""
+Local on-disk cache of the model artifacts, so the API can start (and serve) without
+reaching the MLflow tracking server or the S3 artifact store.
+
+Each model is stored once under `MODEL_CACHE_DIR/<sha256 of its content>/` and `index.json`
+maps the model uris (`runs:/...` or `models:/<name>/<version>`) to those directories.
+
+Pre-warm the cache (e.g. before building the docker image):
+
+    python artifact_cache.py warm                      # latest version of MODEL_NAME (or MODEL_URI)
+    python artifact_cache.py warm runs:/<run_id>/getaround_project
+    python artifact_cache.py list
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache"))
+
+
+def directory_hash(path):
+    """sha256 over the relative paths and content of every file of `path`."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def is_immutable(uri):
+    """Only uris pointing at a fixed run / version can be served from the cache."""
+    if uri.startswith("runs:/"):
+        return True
+    if uri.startswith("models:/"):
+        return uri.rstrip("/").rsplit("/", 1)[-1].isdigit()
+    return False
+
+
+class ArtifactCache:
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+    @contextmanager
+    def _locked(self):
+        # Several gunicorn workers may fill the cache at the same time
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def entries(self):
+        return self._read_index()
+
+    def lookup(self, uri):
+        """Local directory of `uri` if it is cached, else None."""
+        entry = self._read_index().get(uri)
+        if entry is None:
+            return None
+        path = os.path.join(self.cache_dir, entry["sha256"])
+        return path if os.path.isdir(path) else None
+
+    def latest(self, model_name):
+        """(uri, entry) of the most recent cached version of `model_name`, None if there is none."""
+        versions = [
+            (uri, entry) for uri, entry in self._read_index().items()
+            if entry.get("name") == model_name and entry.get("version") is not None
+        ]
+        if not versions:
+            return None
+        return max(versions, key=lambda item: int(item[1]["version"]))
+
+    def fetch(self, uri, name=None, version=None):
+        """Download `uri` from the remote store into the cache and return its local directory."""
+        import mlflow
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".download-", dir=self.cache_dir)
+        try:
+            local_path = mlflow.artifacts.download_artifacts(artifact_uri=uri, dst_path=tmp_dir)
+            sha256 = directory_hash(local_path)
+            path = os.path.join(self.cache_dir, sha256)
+            with self._locked():
+                if not os.path.isdir(path):
+                    os.replace(local_path, path)
+                index = self._read_index()
+                index[uri] = {"sha256": sha256, "name": name, "version": version, "cached_at": time.time()}
+                self._write_index(index)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.info("Cached %s in %s", uri, path)
+        return path
+
+    def resolve(self, uri, name=None, version=None):
+        """Local directory of `uri`, fetched from the remote store only on a cache miss."""
+        if not is_immutable(uri):
+            # e.g. models:/name/latest or a local path, nothing to cache
+            return uri
+        path = self.lookup(uri)
+        if path is not None:
+            return path
+        return self.fetch(uri, name=name, version=version)
+
+
+def warm(cache, uris, model_name, default_uri):
+    if not uris:
+        try:
+            from mlflow.tracking import MlflowClient
+            versions = MlflowClient().search_model_versions(f"name='{model_name}'")
+        except Exception:
+            logger.exception("Could not reach the model registry")
+            versions = []
+        if versions:
+            latest = max(versions, key=lambda v: int(v.version))
+            cache.resolve(f"models:/{model_name}/{latest.version}", name=model_name, version=latest.version)
+        else:
+            cache.resolve(default_uri)
+        return
+    for uri in uris:
+        parts = uri.rstrip("/").split("/")
+        if uri.startswith("models:/") and len(parts) == 3 and parts[2].isdigit():
+            cache.resolve(uri, name=parts[1], version=parts[2])
+        else:
+            cache.resolve(uri)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Manage the local model artifact cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    warm_parser = subparsers.add_parser("warm", help="Download models into the cache")
+    warm_parser.add_argument("uris", nargs="*", help="Model uris, defaults to the latest registered version")
+    subparsers.add_parser("list", help="List cached models")
+    args = parser.parse_args()
+
+    cache = ArtifactCache()
+    if args.command == "warm":
+        warm(
+            cache,
+            args.uris,
+            model_name=os.environ.get("MODEL_NAME", "api_linear_regression"),
+            default_uri=os.environ.get("MODEL_URI", "runs:/1ba78b657fc4426c8bec1a2731fecab7/getaround_project")
+        )
+    else:
+        json.dump(cache.entries(), sys.stdout, indent=2, sort_keys=True)
+        print()
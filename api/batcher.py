@@ -0,0 +1,124 @@
+import time
+import asyncio
+import logging
+
+from executors import Overloaded
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the batch size histogram
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class PredictionBatcher:
+    """
+    Gathers the single predictions awaited concurrently into one vectorized call.
+
+    The first queued prediction opens a batch, then everything queued within `max_wait_ms`
+    (up to `max_batch_size` predictions) is scored together by `predict_batch(records)`
+    and each caller gets its own result back. With an `executor` (see executors.py) batches are
+    scored in its pool, the next batch gathering while the previous one is computed.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=64, max_wait_ms=2.0, executor=None):
+        self.predict_batch = predict_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._task = None
+        self._flushes = set()
+        # Metrics
+        self.batches = 0
+        self.predictions = 0
+        self.batch_size_counts = {bucket: 0 for bucket in BATCH_SIZE_BUCKETS + (float("inf"),)}
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def predict(self, record):
+        """Prediction for one record, scored along with the other pending ones."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((record, future, time.perf_counter()))
+        return await future
+
+    def _drain(self, batch):
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            self._drain(batch)
+            if len(batch) < self.max_batch_size and self.max_wait > 0:
+                # Leave a little time to the requests arriving right behind
+                await asyncio.sleep(self.max_wait)
+                self._drain(batch)
+            if self.executor is None:
+                await self._flush(batch)
+            else:
+                flush = asyncio.get_running_loop().create_task(self._flush(batch))
+                # Keep a reference until done, the loop only keeps weak ones
+                self._flushes.add(flush)
+                flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        self._record(batch, started)
+        records = [record for record, _, _ in batch]
+        try:
+            if self.executor is None:
+                predictions = self.predict_batch(records)
+            else:
+                predictions = await self.executor.run(self.predict_batch, records)
+        except Exception as e:
+            if not isinstance(e, Overloaded):
+                logger.exception("Batch of %s predictions failed", len(batch))
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), prediction in zip(batch, predictions):
+            # The request may have been cancelled (client gone) while waiting
+            if not future.done():
+                future.set_result(prediction)
+
+    def _record(self, batch, started):
+        self.batches += 1
+        self.predictions += len(batch)
+        for bucket in self.batch_size_counts:
+            if len(batch) <= bucket:
+                self.batch_size_counts[bucket] += 1
+                break
+        for _, _, enqueued in batch:
+            wait = started - enqueued
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "predictions": self.predictions,
+            "mean_batch_size": self.predictions / self.batches if self.batches else 0,
+            "batch_size_counts": {str(bucket): count for bucket, count in self.batch_size_counts.items()},
+            "mean_queue_wait_ms": self.queue_wait_total / self.predictions * 1000 if self.predictions else 0,
+            "max_queue_wait_ms": self.queue_wait_max * 1000,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
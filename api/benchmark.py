@@ -0,0 +1,428 @@
+"""
+Load testing / benchmark of the API, reproducible offline.
+
+By default the API runs in-process with a stand-in model (the pipeline of
+`machine_learning/train.py` fitted on `data/test_data.csv` with a synthetic price), so no
+tracking server, S3 or network is needed. `/predict` and `/batch-predict` are driven at each
+concurrency / batch size and throughput, p50 / p95 / p99 latency (successful requests only),
+error rate and peak RSS are reported.
+
+    python benchmark.py --output results.json
+    python benchmark.py --output results.json --baseline baseline.json   # exit code 1 on regression
+    python benchmark.py --uvicorn                                         # against a local uvicorn
+    python benchmark.py --url http://localhost:4000                       # against a running API
+    python benchmark.py --startup                                         # cold start, full vs slim (MODEL_PATH)
+    python benchmark.py --workers 1 2 4                                   # gunicorn memory per worker count
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEST_DATA = os.path.join(HERE, "data", "test_data.csv")
+
+
+def train_standin_model(path):
+    """Fit the train.py pipeline on the test data (random price) and save it as an MLflow model."""
+    import mlflow.sklearn
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+
+    rng = np.random.default_rng(0)
+    X = pd.read_csv(TEST_DATA).sample(2000, replace=True, random_state=0)
+    X["mileage"] = rng.integers(0, 300000, len(X))
+    X["engine_power"] = rng.integers(60, 300, len(X))
+    Y = 150 - X["mileage"] / 5000 + X["engine_power"] / 3 + rng.normal(0, 10, len(X))
+
+    numeric_features = ["mileage", "engine_power"]
+    categorical_features = [col for col in X.columns if col not in numeric_features]
+    model = Pipeline(steps=[
+        ("Preprocessing", ColumnTransformer(transformers=[
+            ("num", StandardScaler(), numeric_features),
+            ("cat", OneHotEncoder(drop='first', handle_unknown='ignore'), categorical_features),
+        ])),
+        ("Regressor", LinearRegression())
+    ])
+    model.fit(X, Y)
+    mlflow.sklearn.save_model(model, path, serialization_format="cloudpickle")
+    return path
+
+
+def standin_environment(workdir, use_cache=False, slim=False):
+    """
+    Environment variables making the API serve the stand-in model, fully offline. With `slim` it's
+    served from its compiled table (`MODEL_PATH`), as the slim image does.
+    """
+    model_path = os.path.join(workdir, "model")
+    if not os.path.exists(model_path):
+        train_standin_model(model_path)
+    environment = {
+        "MODEL_URI": model_path,
+        "MODEL_POLL_INTERVAL": "0",
+        "MODEL_CACHE_DIR": os.path.join(workdir, "model_cache"),
+        "MLFLOW_TRACKING_URI": f"sqlite:///{os.path.join(workdir, 'mlflow.db')}",
+        "JOB_SPOOL_DIR": os.path.join(workdir, "jobs"),
+        "PREDICTION_CACHE_BACKEND": "memory" if use_cache else "none",
+    }
+    if slim:
+        compiled_path = os.path.join(workdir, "model.npz")
+        if not os.path.exists(compiled_path):
+            subprocess.run([sys.executable, "scorer.py", "export", model_path, compiled_path], cwd=HERE, env={**os.environ, **environment}, check=True)
+        environment["MODEL_PATH"] = compiled_path
+    return environment
+
+
+def sample_payloads(n):
+    """`n` /predict bodies taken from the test data, with varying mileage (distinct cache keys)."""
+    rows = pd.read_csv(TEST_DATA).sample(n, replace=True, random_state=1)
+    rows["mileage"] = np.random.default_rng(1).integers(0, 300000, n)
+    return [{key: (value.item() if hasattr(value, "item") else value) for key, value in row.items()} for row in rows.to_dict(orient="records")]
+
+
+def batch_file(size):
+    return pd.read_csv(TEST_DATA).sample(size, replace=True, random_state=2).to_csv(index=False).encode()
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident memory of this process (or of `pid`) in MB."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        return None
+    return None
+
+
+async def drive(client, concurrency, total, send):
+    """
+    Send `total` requests with `concurrency` in flight, return (latencies of the successful requests,
+    number of failed ones (503 included), wall time).
+    """
+    latencies, errors = [], 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < total:
+            i = next_request
+            next_request += 1
+            started = time.perf_counter()
+            response = await send(client, i)
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def summarize(latencies, errors, wall, rows_per_request=1):
+    """Throughput and latencies of the successful requests only, a refused batch scored no rows."""
+    latencies = np.array(latencies) * 1000
+    requests = len(latencies) + errors
+    return {
+        "requests": requests,
+        "errors": errors,
+        "error_rate": errors / requests if requests else 0.0,
+        "throughput_rps": len(latencies) / wall,
+        "rows_per_second": len(latencies) * rows_per_request / wall,
+        "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+
+async def run_scenarios(client, args):
+    results = {}
+    payloads = sample_payloads(args.requests)
+
+    async def send_predict(client, i):
+        return await client.post("/predict", json=payloads[i % len(payloads)])
+
+    # Warm up (first request, lazy imports...)
+    await send_predict(client, 0)
+
+    for concurrency in args.concurrency:
+        latencies, errors, wall = await drive(client, concurrency, args.requests, send_predict)
+        results[f"predict_c{concurrency}"] = summarize(latencies, errors, wall)
+        print(f"predict c={concurrency}: {results[f'predict_c{concurrency}']}")
+
+    for size in args.batch_sizes:
+        content = batch_file(size)
+
+        async def send_batch(client, i):
+            return await client.post("/batch-predict", files={"file": ("batch.csv", content, "text/csv")})
+
+        for concurrency in args.batch_concurrency:
+            latencies, errors, wall = await drive(client, concurrency, args.batch_requests, send_batch)
+            name = f"batch{size}_c{concurrency}"
+            results[name] = summarize(latencies, errors, wall, rows_per_request=size)
+            print(f"batch-predict rows={size} c={concurrency}: {results[name]}")
+
+    return results
+
+
+async def run_in_process(args):
+    import httpx
+    from app import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=600) as client:
+            return await run_scenarios(client, args)
+
+
+async def run_remote(args, url):
+    import httpx
+
+    limits = httpx.Limits(max_connections=max(args.concurrency + args.batch_concurrency))
+    async with httpx.AsyncClient(base_url=url, timeout=600, limits=limits) as client:
+        return await run_scenarios(client, args)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_uvicorn(environment):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env={**os.environ, **environment}
+    )
+    url = f"http://127.0.0.1:{port}"
+    import httpx
+    for _ in range(600):
+        try:
+            if httpx.get(url + "/model").status_code == 200:
+                return process, url
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("uvicorn did not start")
+
+
+def import_profile(environment, top=10):
+    """Seconds taken by `import app` in a fresh interpreter and the `top` slowest packages it imports."""
+    code = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], cwd=HERE, env={**os.environ, **environment},
+        capture_output=True, text=True, check=True
+    )
+    # -X importtime lines: "import time: self [us] | cumulative [us] | imported package"
+    packages = {}
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            package = fields[2].strip().split(".")[0]
+            packages[package] = max(packages.get(package, 0), int(fields[1]) / 1e6)
+    packages.pop("app", None)
+    slowest = sorted(packages.items(), key=lambda package: package[1], reverse=True)[:top]
+    return float(process.stdout.split()[-1]), dict(slowest)
+
+
+def first_prediction_seconds(environment):
+    """Seconds from spawning uvicorn to the first successful /predict."""
+    import httpx
+
+    port = free_port()
+    with open(os.path.join(HERE, "mock_data")) as f:
+        payload = json.load(f)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env={**os.environ, **environment}
+    )
+    try:
+        while time.perf_counter() - started < 120:
+            try:
+                if httpx.post(f"http://127.0.0.1:{port}/predict", json=payload).status_code == 200:
+                    return time.perf_counter() - started
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("uvicorn did not start")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_startup(workdir, runs=3):
+    """Cold start of the full (MLflow model) and slim (compiled table) modes, best of `runs`."""
+    results = {}
+    for mode in ("full", "slim"):
+        environment = standin_environment(workdir, slim=mode == "slim")
+        profiles = [import_profile(environment) for _ in range(runs)]
+        import_seconds, slowest_imports = min(profiles, key=lambda profile: profile[0])
+        results[f"startup_{mode}"] = {
+            "import_app_s": import_seconds,
+            "first_prediction_s": min(first_prediction_seconds(environment) for _ in range(runs)),
+            "slowest_imports_s": slowest_imports,
+        }
+        print(f"startup {mode}: {results[f'startup_{mode}']}")
+    return results
+
+
+def pss_mb(pid):
+    """Proportional set size of `pid` in MB: pages shared with other processes are split between them."""
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def gunicorn_memory(environment, workers, preload):
+    """Total PSS (master + workers) of gunicorn serving the model with `workers` workers."""
+    import httpx
+
+    port = free_port()
+    environment = {**os.environ, **environment, "PORT": str(port), "WEB_CONCURRENCY": str(workers), "PRELOAD_APP": "1" if preload else "0"}
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:app", "-c", "gunicorn.conf.py"], cwd=HERE, env=environment)
+    with open(os.path.join(HERE, "mock_data")) as f:
+        payload = json.load(f)
+    try:
+        started = time.perf_counter()
+        answered = 0
+        # Each worker has to load / touch the model before its memory is measured
+        while answered < 20 * workers:
+            if time.perf_counter() - started > 300:
+                raise RuntimeError("gunicorn did not start")
+            try:
+                answered += httpx.post(f"http://127.0.0.1:{port}/predict", json=payload).status_code == 200
+            except httpx.TransportError:
+                time.sleep(0.1)
+        with open(f"/proc/{process.pid}/task/{process.pid}/children") as f:
+            children = [int(pid) for pid in f.read().split()]
+        return pss_mb(process.pid) + sum(pss_mb(pid) for pid in children)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_workers(workdir, worker_counts):
+    results = {}
+    environment = standin_environment(workdir)
+    for preload in (False, True):
+        for workers in worker_counts:
+            name = f"gunicorn_w{workers}_{'preload' if preload else 'no_preload'}"
+            results[name] = {"pss_mb": gunicorn_memory(environment, workers, preload)}
+            print(f"{name}: {results[name]}")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Scenarios whose throughput dropped / p95 rose more than `tolerance` compared with `baseline`."""
+    regressions = []
+    for name, reference in baseline["scenarios"].items():
+        current = results["scenarios"].get(name)
+        if current is None:
+            continue
+        if name.startswith("gunicorn_"):
+            if current["pss_mb"] > reference["pss_mb"] * (1 + tolerance):
+                regressions.append(f"{name}: {current['pss_mb']:.0f} MB vs {reference['pss_mb']:.0f} MB")
+            continue
+        if name.startswith("startup_"):
+            for key in ("import_app_s", "first_prediction_s"):
+                if current[key] > reference[key] * (1 + tolerance):
+                    regressions.append(f"{name}: {key} {current[key]:.2f} s vs {reference[key]:.2f} s")
+            continue
+        if current["throughput_rps"] < reference["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput_rps']:.1f} rps vs {reference['throughput_rps']:.1f} rps")
+        if current["p95_ms"] is None:
+            regressions.append(f"{name}: every request failed")
+        elif reference["p95_ms"] is not None and current["p95_ms"] > reference["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']:.2f} ms vs {reference['p95_ms']:.2f} ms")
+        # Baselines written before the error rate was recorded count as error free
+        if current["error_rate"] > reference.get("error_rate", 0.0) + tolerance:
+            regressions.append(f"{name}: {current['error_rate']:.0%} errors vs {reference.get('error_rate', 0.0):.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark /predict and /batch-predict")
+    parser.add_argument("--url", help="Benchmark a running API instead of an in-process one")
+    parser.add_argument("--uvicorn", action="store_true", help="Start a local uvicorn serving the stand-in model")
+    parser.add_argument("--startup", action="store_true", help="Measure the cold start (import time, time to first prediction) instead")
+    parser.add_argument("--workers", type=int, nargs="+", help="Measure the memory of gunicorn with these worker counts instead")
+    parser.add_argument("--with-cache", action="store_true", help="Keep the prediction cache on (off by default)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=500, help="/predict requests per concurrency level")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 10000])
+    parser.add_argument("--batch-concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-requests", type=int, default=20, help="/batch-predict requests per scenario")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="getaround-benchmark-")
+    if args.workers:
+        mode = "gunicorn"
+        scenarios = run_workers(workdir, args.workers)
+    elif args.startup:
+        mode = "startup"
+        scenarios = run_startup(workdir)
+    elif args.url:
+        mode = "remote"
+        scenarios = asyncio.run(run_remote(args, args.url))
+    elif args.uvicorn:
+        mode = "uvicorn"
+        process, url = start_uvicorn(standin_environment(workdir, args.with_cache))
+        try:
+            scenarios = asyncio.run(run_remote(args, url))
+            rss = peak_rss_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    else:
+        mode = "in-process"
+        os.environ.update(standin_environment(workdir, args.with_cache))
+        sys.path.insert(0, HERE)
+        scenarios = asyncio.run(run_in_process(args))
+
+    results = {
+        "meta": {
+            "mode": mode,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "prediction_cache": args.with_cache,
+            "peak_rss_mb": rss if mode == "uvicorn" else (peak_rss_mb() if mode == "in-process" else None),
+        },
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regression compared with", args.baseline)
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Overloaded(Exception):
+    """The pool already has as many tasks waiting as it accepts. Turned into a 503 by the API."""
+
+    def __init__(self, pool):
+        super().__init__(f"The {pool} pool is full")
+        self.pool = pool
+
+
+class BoundedExecutor:
+    """
+    Thread pool running the CPU bound work (parsing, predictions) off the event loop.
+
+    At most `max_workers + max_queue` tasks are accepted at a time, the next ones are refused
+    with `Overloaded` instead of piling up. numpy / pandas / sklearn release the GIL in their
+    heavy parts, so the event loop keeps serving requests while the pool computes.
+    """
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self.rejected = 0
+
+    def admit(self):
+        """
+        Take an admission slot for a task made of several steps (e.g. a streamed file), whose steps
+        are then submitted with `admit=False`. Returns the function giving the slot back, it can be
+        called more than once.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise Overloaded(self.name)
+        lock = threading.Lock()
+        held = [True]
+
+        def release():
+            with lock:
+                if held[0]:
+                    held[0] = False
+                    self._slots.release()
+        return release
+
+    def submit(self, fn, *args, admit=True):
+        """
+        Run `fn(*args)` in the pool. With `admit=False` the task skips the admission check, for
+        the steps of a task holding a slot taken with `admit`.
+        """
+        if admit:
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                raise Overloaded(self.name)
+            future = self._executor.submit(fn, *args)
+            future.add_done_callback(lambda _: self._slots.release())
+        else:
+            future = self._executor.submit(fn, *args)
+        with self._pending_lock:
+            self._pending += 1
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _):
+        with self._pending_lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, admit=True):
+        return await asyncio.wrap_future(self.submit(fn, *args, admit=admit))
+
+    async def iterate(self, iterator, release=None):
+        """
+        Async iterator pulling each item of a (blocking) iterator from the pool, on the slot taken
+        by `admit`: `release` is called when the iterator is exhausted, fails or is closed (client gone).
+        """
+        done = object()
+        try:
+            while True:
+                item = await self.run(next, iterator, done, admit=False)
+                if item is done:
+                    return
+                yield item
+        finally:
+            if release is not None:
+                release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "pending": self._pending,
+            "rejected": self.rejected,
+        }
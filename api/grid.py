@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+
+
+class PriceGrid:
+    """
+    Cartesian grid of cars: one base car whose `axes` fields take every combination of values.
+
+    Row i of the grid takes value `(i // stride) % len(values)` of each axis (the last axis
+    varies fastest), so any slice of the grid is built with a few vectorized operations, without
+    materializing the whole grid.
+    """
+
+    def __init__(self, base, axes):
+        self.base = dict(base)
+        self.fields = list(axes)
+        self.values = [list(values) for values in axes.values()]
+        # Python ints: the size of a grid way over the limit must not wrap around
+        self.size = math.prod(len(values) for values in self.values)
+        self.strides = []
+        stride = 1
+        for values in reversed(self.values):
+            self.strides.insert(0, stride)
+            stride *= len(values)
+
+    def frame(self, start, stop):
+        """DataFrame of the rows `start` to `stop` of the grid (text fields as categoricals)."""
+        import pandas as pd
+
+        index = np.arange(start, stop, dtype=np.int64)
+        columns = {}
+        for name, value in self.base.items():
+            if isinstance(value, str):
+                columns[name] = pd.Categorical.from_codes(np.zeros(len(index), dtype=np.int8), categories=[value])
+            else:
+                columns[name] = np.full(len(index), value)
+        for name, values, stride in zip(self.fields, self.values, self.strides):
+            codes = (index // stride) % len(values)
+            if isinstance(values[0], str):
+                columns[name] = pd.Categorical.from_codes(codes, categories=values)
+            else:
+                columns[name] = np.asarray(values)[codes]
+        return pd.DataFrame(columns)
+
+    def frames(self, chunksize):
+        for start in range(0, self.size, chunksize):
+            yield self.frame(start, min(start + chunksize, self.size))
+
+
+def axis_values(values=None, start=None, stop=None, step=None, max_values=None):
+    """Values of an axis given as a list, or as a range (`stop` included) of at most `max_values` values."""
+    if values is not None:
+        if not values:
+            raise ValueError("values can't be empty")
+        # Duplicates would only make the grid bigger
+        return list(dict.fromkeys(values))
+    if start is None or stop is None or step is None:
+        raise ValueError("give either values or start, stop and step")
+    if not all(math.isfinite(bound) for bound in (start, stop, step)):
+        raise ValueError("start, stop and step must be finite numbers")
+    if step <= 0 or stop < start:
+        raise ValueError("step must be positive and stop greater than start")
+    count = (stop - start) / step
+    if not math.isfinite(count):
+        raise ValueError("step is too small for this range")
+    count = int(np.floor(count + 1e-9)) + 1
+    if max_values is not None and count > max_values:
+        raise ValueError(f"range has {count} values, at most {max_values} are allowed")
+    return (start + step * np.arange(count)).tolist()
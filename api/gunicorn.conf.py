@@ -0,0 +1,32 @@
+"""
+Gunicorn settings of the API: `gunicorn app:app -c gunicorn.conf.py`
+
+The app (and the model, PRELOAD_MODEL) is loaded once in the master before the workers are
+forked, so they all share the same model pages copy-on-write instead of each loading its own copy:
+memory stays nearly flat as workers are added. Set PRELOAD_APP=0 to load it in each worker
+(e.g. to reload the code without restarting the master).
+"""
+import os
+import gc
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 4000)}"
+worker_class = "uvicorn.workers.UvicornWorker"
+# One worker per core available to the container
+workers = int(os.environ.get("WEB_CONCURRENCY", len(os.sched_getaffinity(0))))
+preload_app = os.environ.get("PRELOAD_APP", "1") == "1"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+if preload_app:
+    os.environ.setdefault("PRELOAD_MODEL", "1")
+
+
+def when_ready(server):
+    # Objects loaded so far (modules, model) are moved out of the collector's reach: collections
+    # in the workers would otherwise write to their headers and copy the shared pages
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
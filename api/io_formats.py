@@ -0,0 +1,190 @@
+"""
+Readers / writers used by the batch endpoints. Files are read and scored chunk by chunk so the
+memory used stays the same whatever the size of the upload.
+
+Supported formats: csv, Parquet and Arrow IPC (file or stream). Text columns of columnar files
+are read as dictionary encoded / categorical columns, which the compiled scorer looks up once
+per category. pandas / pyarrow are only imported when a file is read (fast startup).
+"""
+import json
+import importlib.util
+
+import numpy as np
+
+# Upload formats, by content type then by file extension
+INPUT_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+    "application/vnd.apache.arrow.file": "arrow",
+    "application/vnd.apache.arrow.stream": "arrows",
+}
+INPUT_EXTENSIONS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".arrows": "arrows",
+}
+
+# Formats the predictions can be streamed back in
+STREAMING_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def detect_format(content_type, filename):
+    """Format of an upload: its content type, else its extension, else csv."""
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in INPUT_CONTENT_TYPES:
+        return INPUT_CONTENT_TYPES[content_type]
+    for extension, input_format in INPUT_EXTENSIONS.items():
+        if (filename or "").lower().endswith(extension):
+            return input_format
+    return "csv"
+
+
+def format_supported(input_format):
+    """Columnar formats need pyarrow, which the slim image may not have."""
+    return input_format == "csv" or importlib.util.find_spec("pyarrow") is not None
+
+
+def read_csv_chunks(file, chunksize):
+    """DataFrames of at most `chunksize` rows read from a csv file object."""
+    import pandas as pd
+
+    for chunk in pd.read_csv(file, chunksize=chunksize):
+        yield chunk
+
+
+def read_parquet_chunks(file, chunksize):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(file)
+    file.seek(0)
+    # Text columns come out of the file as dictionary arrays -> categorical columns
+    text_columns = [field.name for field in schema if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)]
+    parquet_file = pq.ParquetFile(file, read_dictionary=text_columns)
+    for batch in parquet_file.iter_batches(batch_size=chunksize):
+        yield batch.to_pandas()
+
+
+def read_arrow_chunks(file, chunksize, stream=False):
+    import pyarrow as pa
+
+    reader = pa.ipc.open_stream(file) if stream else pa.ipc.open_file(file)
+    batches = reader if stream else (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for batch in batches:
+        batch = _dictionary_encode(batch)
+        # Record batches are as large as the writer made them, slice them (zero copy) to chunksize
+        for offset in range(0, batch.num_rows, chunksize):
+            yield batch.slice(offset, chunksize).to_pandas()
+
+
+def _dictionary_encode(batch):
+    import pyarrow as pa
+
+    columns = [
+        column.dictionary_encode() if pa.types.is_string(column.type) or pa.types.is_large_string(column.type) else column
+        for column in batch.columns
+    ]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def read_chunks(file, input_format, chunksize):
+    """DataFrames of at most `chunksize` rows read from an upload of the given format."""
+    if input_format == "parquet":
+        return read_parquet_chunks(file, chunksize)
+    if input_format in ("arrow", "arrows"):
+        return read_arrow_chunks(file, chunksize, stream=input_format == "arrows")
+    return read_csv_chunks(file, chunksize)
+
+
+def format_chunk(rows, predictions, output):
+    """Text of one chunk of predictions, each line carrying its row index."""
+    if output == "csv":
+        return "".join(f"{row},{prediction!r}\n" for row, prediction in zip(rows.tolist(), predictions.tolist()))
+    return "".join(json.dumps({"row": row, "prediction": prediction}) + "\n" for row, prediction in zip(rows.tolist(), predictions.tolist()))
+
+
+class _Drain:
+    """Write only file object whose content is handed over (then forgotten) chunk by chunk."""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _format_columnar(scored, output):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("row", pa.int64()), ("prediction", pa.float64())])
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema) if output == "parquet" else pa.ipc.new_stream(sink, schema)
+    for rows, predictions in scored:
+        table = pa.table({"row": rows, "prediction": predictions}, schema=schema)
+        if output == "parquet":
+            writer.write_table(table)
+        else:
+            writer.write_batch(table.to_batches()[0])
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def score_chunks(model, chunks):
+    """Predict each chunk, yields the index of its rows and their predictions."""
+    start = 0
+    for chunk in chunks:
+        predictions = np.asarray(model.predict(chunk), dtype=np.float64)
+        rows = np.arange(start, start + len(chunk))
+        start += len(chunk)
+        yield rows, predictions
+
+
+def format_predictions(scored, output):
+    """Yield the results of `score_chunks` in the `output` format as soon as they are ready."""
+    if output in ("parquet", "arrow"):
+        yield from _format_columnar(scored, output)
+        return
+    if output == "csv":
+        yield "row,prediction\n"
+    for rows, predictions in scored:
+        yield format_chunk(rows, predictions, output)
+
+
+def stream_predictions(model, chunks, output):
+    """Predict each chunk and yield the results as soon as they are ready."""
+    return format_predictions(score_chunks(model, chunks), output)
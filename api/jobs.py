@@ -0,0 +1,190 @@
+"""
+Asynchronous batch pricing jobs.
+
+A job is a directory of the spool (`JOB_SPOOL_DIR`) holding the uploaded file, its `status.json`
+(status, rows done...) and the predictions once computed, so jobs survive a restart: unfinished
+jobs found in the spool at startup are run again. A job is claimed (`claim` file) by the worker
+running it, so several gunicorn workers sharing the spool never run the same job twice.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import shutil
+import logging
+import threading
+
+from executors import Overloaded
+from io_formats import INPUT_EXTENSIONS, detect_format, read_chunks, stream_predictions
+
+logger = logging.getLogger(__name__)
+
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class JobManager:
+
+    def __init__(self, spool_dir, get_model, max_concurrent=2, max_queued=100, chunksize=10000,
+                 retention=7 * 24 * 3600, stale_after=600):
+        self.spool_dir = spool_dir
+        self.get_model = get_model
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.chunksize = chunksize
+        # Finished jobs are deleted after `retention` seconds, a claim not updated for
+        # `stale_after` seconds is considered abandoned
+        self.retention = retention
+        self.stale_after = stale_after
+        self._queue = queue.Queue()
+        self._threads = []
+        self._stop = threading.Event()
+
+    def _path(self, job_id, *names):
+        return os.path.join(self.spool_dir, job_id, *names)
+
+    def _write_status(self, job_id, **changes):
+        status = self.status(job_id) or {}
+        status.update(changes, updated_at=time.time())
+        tmp_path = self._path(job_id, "status.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self._path(job_id, "status.json"))
+        return status
+
+    def status(self, job_id):
+        """Status of a job, None if there is no such job."""
+        if not JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(self._path(job_id, "status.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def result_path(self, job_id):
+        return self._path(job_id, "results.csv")
+
+    def submit(self, file, filename, content_type):
+        """Save the upload in the spool and queue the job. Raises Overloaded when the queue is full."""
+        if self._queue.qsize() >= self.max_queued:
+            raise Overloaded("jobs")
+        job_id = uuid.uuid4().hex
+        input_format = detect_format(content_type, filename)
+        extension = {value: key for key, value in INPUT_EXTENSIONS.items()}[input_format]
+        os.makedirs(self._path(job_id))
+        with open(self._path(job_id, "input" + extension), "wb") as f:
+            shutil.copyfileobj(file, f, 1 << 20)
+        status = self._write_status(
+            job_id, id=job_id, status="queued", input=f"input{extension}", input_format=input_format,
+            filename=filename, rows_done=0, created_at=time.time()
+        )
+        self._queue.put(job_id)
+        return status
+
+    def start(self):
+        """Queue again the unfinished jobs of the spool and start the job workers."""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._stop.clear()
+        for job_id in sorted(os.listdir(self.spool_dir), key=lambda name: os.path.getmtime(os.path.join(self.spool_dir, name))):
+            status = self.status(job_id)
+            if status is not None and status["status"] in ("queued", "running") and not self._claimed(job_id):
+                logger.info("Resuming job %s", job_id)
+                self._queue.put(job_id)
+        for i in range(self.max_concurrent):
+            thread = threading.Thread(target=self._work, name=f"jobs-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def _claimed(self, job_id):
+        """True if a live worker is running the job. Drops the claims of dead workers."""
+        claim = self._path(job_id, "claim")
+        try:
+            with open(claim) as f:
+                pid = int(f.read() or 0)
+            heartbeat = os.path.getmtime(claim)
+        except (FileNotFoundError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+            alive = time.time() - heartbeat < self.stale_after
+        except OSError:
+            alive = False
+        if not alive:
+            os.remove(claim)
+        return alive
+
+    def _claim(self, job_id):
+        try:
+            fd = os.open(self._path(job_id, "claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except (FileExistsError, FileNotFoundError):
+            # Claimed by another worker, or the job was deleted meanwhile
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def _work(self):
+        while not self._stop.is_set():
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            if not self._claim(job_id):
+                continue
+            try:
+                status = self.status(job_id)
+                if status is None or status["status"] not in ("queued", "running"):
+                    # Deleted, or already run by another worker meanwhile
+                    continue
+                self._run(job_id)
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                if self.status(job_id) is not None:
+                    self._write_status(job_id, status="failed", error=str(e), finished_at=time.time())
+            finally:
+                self._unclaim(job_id)
+            self._cleanup()
+
+    def _unclaim(self, job_id):
+        try:
+            os.remove(self._path(job_id, "claim"))
+        except FileNotFoundError:
+            pass
+
+    def _run(self, job_id):
+        status = self._write_status(job_id, status="running", rows_done=0, started_at=time.time())
+        model = self.get_model()
+        rows_done = 0
+
+        def counted(chunks):
+            nonlocal rows_done
+            for chunk in chunks:
+                rows_done += len(chunk)
+                yield chunk
+
+        partial_path = self._path(job_id, "results.csv.part")
+        with open(self._path(job_id, status["input"]), "rb") as source, open(partial_path, "w") as results:
+            chunks = counted(read_chunks(source, status["input_format"], self.chunksize))
+            for text in stream_predictions(model, chunks, "csv"):
+                results.write(text)
+                self._write_status(job_id, rows_done=rows_done)
+                # Heartbeat of the claim
+                os.utime(self._path(job_id, "claim"))
+                if self._stop.is_set():
+                    return
+        os.replace(partial_path, self.result_path(job_id))
+        self._write_status(job_id, status="done", rows_done=rows_done, finished_at=time.time())
+
+    def _cleanup(self):
+        now = time.time()
+        for job_id in os.listdir(self.spool_dir):
+            status = self.status(job_id)
+            if status is not None and status["status"] in ("done", "failed") and now - status["updated_at"] > self.retention:
+                shutil.rmtree(self._path(job_id), ignore_errors=True)
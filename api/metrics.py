@@ -0,0 +1,229 @@
+"""
+Prometheus metrics of the API, served as text on `/metrics`.
+
+Every route is timed by stage (`TimedRoute`):
+* `validation`: reading the body and validating it with pydantic (until the endpoint is called)
+* `dataframe`: parsing uploaded files into DataFrames
+* `model_lookup`: getting the live model / looking up the prediction cache
+* `predict`: scoring
+* `serialization`: turning what the endpoint returned into the response
+
+With several gunicorn workers set `PROMETHEUS_MULTIPROC_DIR` so that `/metrics` aggregates them all.
+
+Send a request with the `X-Profile: 1` header (and `PROFILING_ENABLED=1`) to profile it,
+the report is written to `PROFILE_DIR` and its path returned in the `X-Profile-Report` header.
+"""
+import os
+import time
+import asyncio
+import functools
+import contextvars
+from contextlib import contextmanager
+
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import HTTPException
+from fastapi.routing import APIRoute
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from executors import Overloaded
+
+LATENCY_BUCKETS = (.00001, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+REQUESTS = Counter("getaround_requests_total", "Requests served", ["endpoint", "method", "status"])
+REQUEST_SECONDS = Histogram("getaround_request_seconds", "Time to answer a request", ["endpoint"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("getaround_stage_seconds", "Time spent in each stage of a request", ["endpoint", "stage"], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge("getaround_requests_in_flight", "Requests being served", multiprocess_mode="livesum")
+BATCH_ROWS = Histogram("getaround_batch_rows", "Rows scored per batch request", ["endpoint"], buckets=ROWS_BUCKETS)
+MODEL_INFO = Gauge("getaround_model_info", "Model served (value is the time it was loaded)", ["name", "version", "uri"], multiprocess_mode="liveall")
+
+# Timings of the request being served
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def observe_stage(endpoint, stage, seconds):
+    STAGE_SECONDS.labels(endpoint, stage).observe(seconds)
+
+
+@contextmanager
+def stage(name, endpoint=None):
+    """Time a block of code as a stage of the current request (or of `endpoint`)."""
+    if endpoint is None:
+        timings = _timings.get()
+        endpoint = timings["endpoint"] if timings is not None else "none"
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(endpoint, name, time.perf_counter() - started)
+
+
+def timed_chunks(chunks, endpoint):
+    """Time the parsing of each chunk of a file, count the rows once the file is done."""
+    rows = 0
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        observe_stage(endpoint, "dataframe", time.perf_counter() - started)
+        rows += len(chunk)
+        yield chunk
+    BATCH_ROWS.labels(endpoint).observe(rows)
+
+
+class TimedModel:
+    """Scorer wrapper timing the `predict` stage (usable from the worker pools)."""
+
+    def __init__(self, model, endpoint):
+        self.model = model
+        self.endpoint = endpoint
+
+    def predict(self, df):
+        with stage("predict", self.endpoint):
+            return self.model.predict(df)
+
+    def predict_records(self, records):
+        with stage("predict", self.endpoint):
+            return self.model.predict_records(records)
+
+
+def _timed_endpoint(endpoint):
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        timings = _timings.get()
+        if timings is not None:
+            timings["endpoint_started"] = time.perf_counter()
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            if timings is not None:
+                timings["endpoint_finished"] = time.perf_counter()
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """Route recording requests count, latency and validation / serialization stages."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = _timed_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        endpoint = self.path
+
+        async def timed_handler(request):
+            timings = {"endpoint": endpoint, "started": time.perf_counter()}
+            token = _timings.set(timings)
+            IN_FLIGHT.inc()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            except RequestValidationError:
+                status = 422
+                raise
+            except Overloaded:
+                # See the Overloaded handler of app.py
+                status = 503
+                raise
+            finally:
+                finished = time.perf_counter()
+                IN_FLIGHT.dec()
+                REQUESTS.labels(endpoint, request.method, status).inc()
+                REQUEST_SECONDS.labels(endpoint).observe(finished - timings["started"])
+                if "endpoint_started" in timings:
+                    observe_stage(endpoint, "validation", timings["endpoint_started"] - timings["started"])
+                if "endpoint_finished" in timings:
+                    observe_stage(endpoint, "serialization", finished - timings["endpoint_finished"])
+                _timings.reset(token)
+
+        return timed_handler
+
+
+def set_model_info(live):
+    MODEL_INFO.clear()
+    MODEL_INFO.labels(live.name, str(live.version), live.uri).set(live.loaded_at)
+
+
+class StatsCollector:
+    """Exposes the numbers of a stats dict (e.g. `/stats`) as gauges: {"cache": {"hits": 1}} -> getaround_cache_hits."""
+
+    def __init__(self, get_stats, prefix="getaround"):
+        self.get_stats = get_stats
+        self.prefix = prefix
+
+    def collect(self):
+        for name, value in self._flatten(self.get_stats(), self.prefix):
+            yield GaugeMetricFamily(name, f"{name} (see /stats)", value=value)
+
+    def _flatten(self, stats, prefix):
+        for key, value in (stats or {}).items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                yield from self._flatten(value, name)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and str(key).replace("_", "").isalnum():
+                yield name, float(value)
+
+
+def register_stats(get_stats):
+    collector = StatsCollector(get_stats)
+    REGISTRY.register(collector)
+    return collector
+
+
+def render(collectors=()):
+    """(body, content type) of the `/metrics` response."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        # Stats of the worker answering the scrape
+        for collector in collectors:
+            registry.register(collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+async def profile_request(request, call_next):
+    """Middleware profiling the requests sent with an `X-Profile` header."""
+    if not request.headers.get("X-Profile") or os.environ.get("PROFILING_ENABLED") != "1":
+        return await call_next(request)
+
+    profile_dir = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+    os.makedirs(profile_dir, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.url.path.strip('/').replace('/', '_') or 'index'}-{os.getpid()}"
+    try:
+        # Sampling profiler, when installed
+        from pyinstrument import Profiler
+    except ImportError:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.disable()
+        path = os.path.join(profile_dir, name + ".prof")
+        profiler.dump_stats(path)
+    else:
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.stop()
+        path = os.path.join(profile_dir, name + ".html")
+        with open(path, "w") as f:
+            f.write(profiler.output_html())
+    response.headers["X-Profile-Report"] = path
+    return response
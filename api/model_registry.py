@@ -0,0 +1,141 @@
+import time
+import logging
+import threading
+from collections import namedtuple
+
+from scorer import load_scorer
+from artifact_cache import ArtifactCache
+
+logger = logging.getLogger(__name__)
+
+# Everything a request needs about the model being served. It is replaced as a whole
+# (one attribute assignment) so a request never sees a half-swapped model.
+# `model` is a scorer (see scorer.py).
+LiveModel = namedtuple("LiveModel", ["name", "version", "uri", "model", "loaded_at"])
+
+
+class ModelRegistry:
+    """
+    Keeps the pricing model in memory for the lifetime of the worker.
+
+    The model is loaded once at startup (latest cached or registered version of `model_name`,
+    `default_uri` when there is none), then a background
+    thread polls the MLflow registry and swaps in newer versions as they get registered.
+    Requests keep the reference they grabbed, so in-flight predictions finish on the old model.
+    Artifacts are read through the local `ArtifactCache`, the remote store is only hit on a miss.
+
+    With a `local_path` (compiled .npz table or local MLflow model) that model is served as is,
+    without polling: mlflow isn't even imported when the path is a compiled table.
+    """
+
+    def __init__(self, model_name, default_uri, poll_interval=60, cache=None, local_path=None):
+        self.model_name = model_name
+        self.default_uri = default_uri
+        self.poll_interval = poll_interval
+        self.cache = cache if cache is not None else ArtifactCache()
+        self.local_path = local_path
+        self._live = None
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # Called with the new LiveModel every time a model is swapped in
+        self.listeners = []
+
+    @property
+    def live(self):
+        return self._live
+
+    @property
+    def model(self):
+        live = self._live
+        if live is None:
+            raise RuntimeError("Model is not loaded yet")
+        return live.model
+
+    def latest_version(self):
+        """Latest version registered under `model_name`, None if there is none."""
+        from mlflow.tracking import MlflowClient
+
+        client = MlflowClient()
+        versions = client.search_model_versions(f"name='{self.model_name}'")
+        if not versions:
+            return None
+        return max(versions, key=lambda v: int(v.version))
+
+    def load(self):
+        """
+        Load the model to serve at startup: the latest cached version if there is one (the poller
+        catches up with the registry afterwards), else the latest registered version, else `default_uri`.
+        """
+        if self.local_path is not None:
+            self._swap(self.local_path, None)
+            return self._live
+
+        cached = self.cache.latest(self.model_name)
+        if cached is not None:
+            uri, entry = cached
+            self._swap(uri, entry["version"])
+            return self._live
+
+        try:
+            version = self.latest_version()
+        except Exception:
+            logger.exception("Could not reach the model registry, loading %s", self.default_uri)
+            version = None
+
+        if version is None:
+            self._swap(self.default_uri, None)
+        else:
+            self._swap(f"models:/{self.model_name}/{version.version}", version.version)
+        return self._live
+
+    def refresh(self):
+        """Swap in the latest registered version if it is newer than the live one."""
+        version = self.latest_version()
+        live = self._live
+        if version is None:
+            return False
+        if live is not None and live.version is not None and int(live.version) >= int(version.version):
+            return False
+        self._swap(f"models:/{self.model_name}/{version.version}", version.version)
+        return True
+
+    def _swap(self, uri, version):
+        with self._load_lock:
+            # Load outside of any request path, then publish with a single assignment
+            path = self.cache.resolve(uri, name=self.model_name if version is not None else None, version=version)
+            # Compiled contribution tables for linear pipelines, the full pipeline otherwise
+            model = load_scorer(path)
+            if version is None:
+                # Compiled tables remember the version they were exported from
+                version = getattr(model, "metadata", {}).get("version")
+            self._live = LiveModel(self.model_name, version, uri, model, time.time())
+        logger.info("Serving %s (version %s)", uri, version)
+        for listener in self.listeners:
+            # The new model is live already, a failing listener mustn't keep the next ones from knowing
+            try:
+                listener(self._live)
+            except Exception:
+                logger.exception("Listener %r failed on the swap to %s", listener, uri)
+
+    def start(self):
+        """Load the model if needed and start polling the registry in the background."""
+        if self._live is None:
+            self.load()
+        if self.poll_interval > 0 and self._thread is None and self.local_path is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._poll, name="model-registry-poll", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Model refresh failed, keeping version %s", getattr(self._live, "version", None))
@@ -0,0 +1,200 @@
+"""
+Cache of the `/predict` results. Keys are a hash of the canonicalized features plus the version
+of the model that made the prediction, so a new model never serves the old model's results
+(and the cache is cleared when the model is swapped).
+
+Two backends:
+* `memory`: LRU + TTL in the worker process (default)
+* `sqlite`: one file shared by all the gunicorn workers of the container (put it on /dev/shm
+  to keep it in memory). Its calls can block on the other workers' writes (`blocking`), the API
+  runs them in a thread, and gives up after `timeout` seconds: a locked cache is a cache miss.
+"""
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def cache_key(features, model_version):
+    """Same key for the same features whatever their order / int vs float representation."""
+    canonical = {
+        name: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+        for name, value in features.items()
+    }
+    payload = json.dumps([str(model_version), canonical], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class PredictionCache:
+    """In-process LRU cache with a time to live."""
+
+    # Cheap enough to be called from the event loop
+    blocking = False
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SqlitePredictionCache:
+    """LRU cache with a time to live stored in a sqlite file shared between processes."""
+
+    blocking = True
+
+    def __init__(self, path, max_size=10000, ttl=3600, timeout=0.05):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        # Busy timeout (seconds): waiting longer for another worker's lock costs more than scoring
+        self.timeout = timeout
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock_errors = 0
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value REAL, expires_at REAL, used_at REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS predictions_used_at ON predictions (used_at)")
+        connection.close()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, nor kept across a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        try:
+            return self._get(key)
+        except sqlite3.OperationalError:
+            # Locked by another worker: scoring is faster than waiting
+            self.lock_errors += 1
+            self.misses += 1
+            return None
+
+    def _get(self, key):
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires_at FROM predictions WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None:
+            self.misses += 1
+            return None
+        if row[1] < now:
+            connection.execute("DELETE FROM predictions WHERE key = ?", (key,))
+            self.expirations += 1
+            self.misses += 1
+            return None
+        connection.execute("UPDATE predictions SET used_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, value):
+        try:
+            self._set(key, value)
+        except sqlite3.OperationalError:
+            self.lock_errors += 1
+
+    def _set(self, key, value):
+        connection = self._connection()
+        now = time.time()
+        connection.execute(
+            "INSERT OR REPLACE INTO predictions (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+            (key, float(value), now + self.ttl, now)
+        )
+        # Trim in one statement every time the table grows 10% over the limit
+        size = connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if size > self.max_size * 1.1:
+            cursor = connection.execute(
+                "DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY used_at LIMIT ?)",
+                (size - self.max_size,)
+            )
+            self.evictions += cursor.rowcount
+
+    def clear(self):
+        # Entries of other model versions can't be hit anymore (the version is part of the key),
+        # only drop the expired ones as other workers may still be on the previous version
+        try:
+            self._connection().execute("DELETE FROM predictions WHERE expires_at < ?", (time.time(),))
+        except sqlite3.OperationalError:
+            # Locked by another worker: they go at the next swap, or when they are looked up
+            self.lock_errors += 1
+
+    def stats(self):
+        size = self._connection().execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "size": size,
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "lock_errors": self.lock_errors,
+        }
+
+
+def make_cache(backend, max_size, ttl, path=None, timeout=0.05):
+    if backend == "sqlite":
+        return SqlitePredictionCache(path, max_size=max_size, ttl=ttl, timeout=timeout)
+    if backend == "memory":
+        return PredictionCache(max_size=max_size, ttl=ttl)
+    return None
@@ -0,0 +1,252 @@
+"""
+Scoring engines used by the API.
+
+The model trained in `machine_learning/train.py` (StandardScaler + OneHotEncoder + linear
+regressor) is just a sum: an intercept, one weight per scaled numeric column and one
+contribution per categorical level. `compile_pipeline` turns such a fitted pipeline into these
+tables, so a prediction is computed straight from the request fields without pandas or sklearn.
+Models that can't be compiled are served by `PipelineScorer` (the full pipeline).
+
+Export the table of a model (e.g. to serve it without mlflow):
+
+    python scorer.py export runs:/<run_id>/getaround_project compiled.npz
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+
+
+class NotCompilable(Exception):
+    """The model isn't a linear pipeline `compile_pipeline` knows how to reduce."""
+
+
+class CompiledLinearModel:
+    """
+    prediction = intercept
+                 + sum(((x - numeric_means) / numeric_scales) * numeric_coefs)
+                 + sum(contribution of each categorical level)
+    Unknown levels contribute 0, as OneHotEncoder(handle_unknown='ignore') does.
+    """
+
+    def __init__(self, intercept, numeric_features, numeric_means, numeric_scales, numeric_coefs,
+                 categorical_features, levels, contributions, metadata=None):
+        self.intercept = float(intercept)
+        self.numeric_features = list(numeric_features)
+        self.numeric_means = np.asarray(numeric_means, dtype=np.float64)
+        self.numeric_scales = np.asarray(numeric_scales, dtype=np.float64)
+        self.numeric_coefs = np.asarray(numeric_coefs, dtype=np.float64)
+        self.categorical_features = list(categorical_features)
+        self.levels = [np.asarray(level, dtype=str) for level in levels]
+        self.contributions = [np.asarray(contribution, dtype=np.float64) for contribution in contributions]
+        self.metadata = dict(metadata or {})
+        # Lookup tables used at prediction time
+        self.tables = [
+            dict(zip(level.tolist(), contribution.tolist()))
+            for level, contribution in zip(self.levels, self.contributions)
+        ]
+
+    def predict_one(self, features):
+        """Prediction for one car given as a mapping of feature name -> value."""
+        prediction = self.intercept
+        for name, mean, scale, coef in zip(self.numeric_features, self.numeric_means, self.numeric_scales, self.numeric_coefs):
+            prediction += (features[name] - mean) / scale * coef
+        for name, table in zip(self.categorical_features, self.tables):
+            prediction += table.get(features[name], 0.0)
+        return prediction
+
+    def predict_records(self, records):
+        """Predictions for a list of mappings (e.g. `dict(PredictionFeatures)`)."""
+        numeric = np.array([[record[name] for name in self.numeric_features] for record in records], dtype=np.float64)
+        predictions = self.intercept + ((numeric - self.numeric_means) / self.numeric_scales) @ self.numeric_coefs
+        for name, table in zip(self.categorical_features, self.tables):
+            predictions += np.fromiter((table.get(record[name], 0.0) for record in records), dtype=np.float64, count=len(records))
+        return predictions
+
+    def predict(self, df):
+        """Predictions for a DataFrame holding (at least) the trained columns."""
+        numeric = df[self.numeric_features].to_numpy(dtype=np.float64)
+        predictions = self.intercept + ((numeric - self.numeric_means) / self.numeric_scales) @ self.numeric_coefs
+        for name, table in zip(self.categorical_features, self.tables):
+            predictions += _lookup(df[name], table)
+        return predictions
+
+    def save(self, path):
+        arrays = {
+            "intercept": np.array(self.intercept),
+            "numeric_features": np.array(self.numeric_features, dtype=str),
+            "numeric_means": self.numeric_means,
+            "numeric_scales": self.numeric_scales,
+            "numeric_coefs": self.numeric_coefs,
+            "categorical_features": np.array(self.categorical_features, dtype=str),
+            "metadata_keys": np.array(list(self.metadata.keys()), dtype=str),
+            "metadata_values": np.array([str(value) for value in self.metadata.values()], dtype=str),
+        }
+        for i, (level, contribution) in enumerate(zip(self.levels, self.contributions)):
+            arrays[f"levels_{i}"] = level
+            arrays[f"contributions_{i}"] = contribution
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            categorical_features = data["categorical_features"].tolist()
+            return cls(
+                intercept=data["intercept"],
+                numeric_features=data["numeric_features"].tolist(),
+                numeric_means=data["numeric_means"],
+                numeric_scales=data["numeric_scales"],
+                numeric_coefs=data["numeric_coefs"],
+                categorical_features=categorical_features,
+                levels=[data[f"levels_{i}"] for i in range(len(categorical_features))],
+                contributions=[data[f"contributions_{i}"] for i in range(len(categorical_features))],
+                metadata=dict(zip(data["metadata_keys"].tolist(), data["metadata_values"].tolist()))
+            )
+
+
+def _lookup(series, table):
+    """Contribution of each value of `series`, 0 for unknown / missing levels."""
+    if str(series.dtype) == "category":
+        # Categorical columns: one lookup per category, then index by the codes
+        categories = series.cat.categories
+        per_category = np.array([table.get(category, 0.0) for category in categories] + [0.0], dtype=np.float64)
+        return per_category[series.cat.codes.to_numpy()]
+    return series.map(table).to_numpy(dtype=np.float64, na_value=0.0)
+
+
+class PipelineScorer:
+    """Fallback: any model with a `predict(DataFrame)` method (sklearn pipeline, pyfunc model)."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict_one(self, features):
+        return self.predict_records([features])[0]
+
+    def predict_records(self, records):
+        import pandas as pd
+        return np.asarray(self.model.predict(pd.DataFrame(list(records))))
+
+    def predict(self, df):
+        return np.asarray(self.model.predict(df))
+
+
+def compile_pipeline(pipeline):
+    """Reduce a fitted Pipeline(ColumnTransformer(StandardScaler, OneHotEncoder), linear regressor)."""
+    from sklearn.pipeline import Pipeline
+    from sklearn.compose import ColumnTransformer
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    if not isinstance(pipeline, Pipeline) or len(pipeline.steps) != 2:
+        raise NotCompilable(f"Expected a 2 steps Pipeline, got {type(pipeline).__name__}")
+    preprocessor, regressor = pipeline.steps[0][1], pipeline.steps[1][1]
+    if not isinstance(preprocessor, ColumnTransformer):
+        raise NotCompilable(f"Expected a ColumnTransformer, got {type(preprocessor).__name__}")
+    if not type(regressor).__module__.startswith("sklearn.linear_model") or not hasattr(regressor, "coef_"):
+        raise NotCompilable(f"{type(regressor).__name__} is not a linear model")
+
+    coefs = np.ravel(regressor.coef_).astype(np.float64)
+    # intercept_ is an array of 1 element for SGDRegressor
+    intercept = float(np.ravel(regressor.intercept_)[0])
+
+    numeric_features, numeric_means, numeric_scales, numeric_coefs = [], [], [], []
+    categorical_features, levels, contributions = [], [], []
+    position = 0
+    for name, transformer, columns in preprocessor.transformers_:
+        if transformer == "drop" or len(columns) == 0:
+            continue
+        if transformer == "passthrough" or not all(isinstance(column, str) for column in columns):
+            raise NotCompilable(f"Transformer {name!r} can't be compiled")
+
+        if isinstance(transformer, StandardScaler):
+            n = len(columns)
+            # mean_ is also fitted with with_mean=False (for the variance), it isn't subtracted then
+            means = transformer.mean_ if transformer.with_mean and transformer.mean_ is not None else np.zeros(n)
+            scales = transformer.scale_ if transformer.with_std and transformer.scale_ is not None else np.ones(n)
+            numeric_features.extend(columns)
+            numeric_means.extend(means)
+            numeric_scales.extend(scales)
+            numeric_coefs.extend(coefs[position:position + n])
+            position += n
+
+        elif isinstance(transformer, OneHotEncoder):
+            if transformer.min_frequency is not None or transformer.max_categories is not None:
+                raise NotCompilable("OneHotEncoder with infrequent categories can't be compiled")
+            drop_idx = transformer.drop_idx_ if transformer.drop_idx_ is not None else [None] * len(columns)
+            for column, categories, dropped in zip(columns, transformer.categories_, drop_idx):
+                if not all(isinstance(category, str) for category in categories):
+                    raise NotCompilable(f"Column {column!r} has non string categories")
+                contribution = np.zeros(len(categories))
+                for i in range(len(categories)):
+                    if dropped is not None and i == dropped:
+                        # Dropped level is encoded as all zeros
+                        continue
+                    contribution[i] = coefs[position]
+                    position += 1
+                categorical_features.append(column)
+                levels.append(np.asarray(categories, dtype=str))
+                contributions.append(contribution)
+        else:
+            raise NotCompilable(f"{type(transformer).__name__} can't be compiled")
+
+    if position != len(coefs):
+        raise NotCompilable(f"Regressor has {len(coefs)} coefficients, preprocessing outputs {position} columns")
+
+    return CompiledLinearModel(
+        intercept=intercept,
+        numeric_features=numeric_features,
+        numeric_means=numeric_means,
+        numeric_scales=numeric_scales,
+        numeric_coefs=numeric_coefs,
+        categorical_features=categorical_features,
+        levels=levels,
+        contributions=contributions,
+        metadata={"regressor": type(regressor).__name__}
+    )
+
+
+def make_scorer(model):
+    """Compiled scorer for the models that allow it, the full pipeline otherwise."""
+    try:
+        return compile_pipeline(model)
+    except NotCompilable:
+        return PipelineScorer(model)
+
+
+def load_scorer(path):
+    """Scorer for a compiled table (`.npz`) or a local MLflow model directory."""
+    if path.endswith(".npz"):
+        return CompiledLinearModel.load(path)
+
+    import mlflow
+    from mlflow.models import Model
+
+    flavors = Model.load(path).flavors
+    if "sklearn" in flavors:
+        return make_scorer(mlflow.sklearn.load_model(path))
+    return PipelineScorer(mlflow.pyfunc.load_model(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a model into per-category contribution tables")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Export the compiled table of a model as .npz")
+    export_parser.add_argument("model", help="Model uri (runs:/, models:/) or local MLflow model directory")
+    export_parser.add_argument("output", help="Path of the .npz file to write")
+    args = parser.parse_args()
+
+    import mlflow
+    from artifact_cache import ArtifactCache
+
+    path = args.model if os.path.isdir(args.model) else ArtifactCache().resolve(args.model)
+    try:
+        compiled = compile_pipeline(mlflow.sklearn.load_model(path))
+    except NotCompilable as e:
+        sys.exit(f"Can't compile {args.model}: {e}")
+    compiled.metadata["source"] = args.model
+    parts = args.model.rstrip("/").split("/")
+    if args.model.startswith("models:/") and parts[-1].isdigit():
+        compiled.metadata["version"] = parts[-1]
+    compiled.save(args.output)
+    print(f"Compiled {args.model} into {args.output}")
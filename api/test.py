@@ -1,5 +1,7 @@
+import os
 import requests 
 import json
+import tempfile
 import pandas as pd 
 
 #### Test ML Model 
@@ -31,7 +33,6 @@ def test_prediction():
     print(response)
     print(response.json())
 
-test_prediction()
 
 ### Test batch pred
 def test_batch():
@@ -57,7 +58,346 @@ def test_batch():
     print(response)
     print(response.json())
 
-test_batch()
+
+#### Sample cars and pipeline of the offline tests
+def sample_cars():
+    # The sample cars of data/test_data.csv, with a made up price (any target works, the tests
+    # compare the API with the fitted pipeline)
+    X = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test_data.csv"))
+    Y = 20 + X["engine_power"] * 0.8 - X["mileage"] / 5000 + (X["fuel"] == "diesel") * 15
+    return X, Y
+
+
+def fit_pipeline(X, Y, scaler=None):
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+
+    numeric_features = ["mileage", "engine_power"]
+    categorical_features = [col for col in X.columns if col not in numeric_features]
+    # Same pipeline as machine_learning/train.py
+    return Pipeline(steps=[
+        ("Preprocessing", ColumnTransformer(transformers=[
+            ("num", scaler if scaler is not None else StandardScaler(), numeric_features),
+            ("cat", OneHotEncoder(drop='first', handle_unknown='ignore'), categorical_features),
+        ])),
+        ("Regressor", LinearRegression())
+    ]).fit(X, Y)
+
+
+#### Test compiled scorer
+def test_compiled_scorer():
+    import numpy as np
+    from sklearn.preprocessing import StandardScaler
+    from scorer import CompiledLinearModel, compile_pipeline
+
+    X, Y = sample_cars()
+    categorical_features = [col for col in X.columns if col not in ("mileage", "engine_power")]
+
+    model = fit_pipeline(X, Y)
+    compiled = compile_pipeline(model)
+    expected = model.predict(X)
+
+    # DataFrame, categorical dtypes, single rows, and after a save / load round trip
+    np.testing.assert_allclose(compiled.predict(X), expected, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose(compiled.predict(X.astype({col: "category" for col in categorical_features})), expected, rtol=1e-9, atol=1e-6)
+    records = X.head(10).to_dict(orient="records")
+    np.testing.assert_allclose(compiled.predict_records(records), expected[:10], rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose([compiled.predict_one(record) for record in records], expected[:10], rtol=1e-9, atol=1e-6)
+
+    # Scalers not centering / not scaling
+    for scaler in (StandardScaler(with_mean=False), StandardScaler(with_std=False), StandardScaler(with_mean=False, with_std=False)):
+        other = fit_pipeline(X, Y, scaler)
+        np.testing.assert_allclose(compile_pipeline(other).predict(X), other.predict(X), rtol=1e-9, atol=1e-6)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        compiled.save(os.path.join(tmp, "compiled_scorer.npz"))
+        reloaded = CompiledLinearModel.load(os.path.join(tmp, "compiled_scorer.npz"))
+    np.testing.assert_allclose(reloaded.predict(X), expected, rtol=1e-9, atol=1e-6)
+    print("Compiled scorer matches Pipeline.predict")
+
+
+#### Local API
+_api = None
+
+def local_api():
+    """
+    The API module (app.py) serving the compiled table of `fit_pipeline`, with its spool in a temporary
+    directory (no registry, no network), and a test client. The app is started once for all the tests
+    (its pools can't be restarted after a shutdown).
+    """
+    global _api
+    if _api is None:
+        import atexit
+        from fastapi.testclient import TestClient
+        from scorer import compile_pipeline
+
+        tmp = tempfile.mkdtemp(prefix="getaround_api_test")
+        compile_pipeline(fit_pipeline(*sample_cars())).save(os.path.join(tmp, "model.npz"))
+        os.environ.update(
+            MODEL_PATH=os.path.join(tmp, "model.npz"), JOB_SPOOL_DIR=os.path.join(tmp, "jobs"),
+            PREDICTION_CACHE_BACKEND="memory"
+        )
+        import app
+        client = TestClient(app.app)
+        client.__enter__()
+        atexit.register(client.__exit__, None, None, None)
+        _api = app, client
+    return _api
+
+
+#### Test micro-batching
+def test_batched_predictions():
+    import asyncio
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+
+    api, client = local_api()
+    X, _ = sample_cars()
+    records = X.to_dict(orient="records")
+    expected = api.registry.model.predict(X)
+
+    # Scored together by the batcher, each request gets its own prediction
+    async def predict_all():
+        return await asyncio.gather(*(api.batcher.predict(record) for record in records))
+
+    batches = api.batcher.batches
+    np.testing.assert_allclose(client.portal.call(predict_all), expected, rtol=1e-9, atol=1e-6)
+    assert api.batcher.batches - batches < len(records)
+
+    # Same through /predict, sent concurrently
+    with ThreadPoolExecutor(len(records)) as pool:
+        responses = list(pool.map(lambda record: client.post("/predict", json=record), records))
+    assert [r.json()["prediction"] for r in responses] == [f"{round(float(p))} euros" for p in expected]
+    print("Batched predictions match the unbatched ones")
+
+
+#### Test overloaded pool
+def test_overloaded():
+    from executors import Overloaded
+
+    api, client = local_api()
+    test_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test_data.csv")
+    # Every slot of the batch pool taken
+    releases = []
+    try:
+        while True:
+            releases.append(api.batch_pool.admit())
+    except Overloaded:
+        pass
+    try:
+        for output in ("json", "csv"):
+            with open(test_file, "rb") as f:
+                r = client.post("/batch-predict", params={"output": output}, files={"file": ("test_data.csv", f, "text/csv")})
+            assert r.status_code == 503, r.text
+            assert r.headers["Retry-After"] == api.RETRY_AFTER
+    finally:
+        for release in releases:
+            release()
+    with open(test_file, "rb") as f:
+        assert client.post("/batch-predict", files={"file": ("test_data.csv", f, "text/csv")}).status_code == 200
+    print("Full pool answers 503 with Retry-After")
+
+
+#### Test streamed batch predictions
+def test_streamed_batch():
+    import io
+    import numpy as np
+
+    api, client = local_api()
+    X, _ = sample_cars()
+    expected = api.registry.model.predict(X)
+
+    r = client.post("/batch-predict", params={"output": "csv", "chunksize": 7}, files={"file": ("cars.csv", X.to_csv(index=False), "text/csv")})
+    assert r.status_code == 200, r.text
+    streamed = pd.read_csv(io.StringIO(r.text))
+    assert streamed["row"].tolist() == list(range(len(X)))
+    np.testing.assert_allclose(streamed["prediction"], expected, rtol=1e-9, atol=1e-6)
+
+    # A file missing a trained column is refused before the response starts
+    for output in ("csv", "ndjson"):
+        missing = X.drop(columns=["engine_power"]).to_csv(index=False)
+        r = client.post("/batch-predict", params={"output": output}, files={"file": ("cars.csv", missing, "text/csv")})
+        assert r.status_code == 422, r.text
+        assert "engine_power" in r.json()["detail"]
+    print("Streamed predictions match, bad files refused with a 422")
+
+
+#### Test prediction cache
+def test_cache_cleared_on_swap():
+    import sqlite3
+    from prometheus_client.parser import text_string_to_metric_families
+    from scorer import compile_pipeline
+    from prediction_cache import SqlitePredictionCache
+
+    api, client = local_api()
+    X, Y = sample_cars()
+    car = X.iloc[0].to_dict()
+    model_path = api.registry.local_path
+    original = open(model_path, "rb").read()
+
+    assert client.post("/predict", json=car).json() == client.post("/predict", json=car).json()
+    hits = api.prediction_cache.hits
+    assert client.post("/predict", json=car).status_code == 200
+    assert api.prediction_cache.hits == hits + 1
+
+    def failing(live):
+        raise RuntimeError("listener down")
+
+    # Another model at the same path: same uri, the cache must not answer with the old prices
+    api.registry.listeners.insert(0, failing)
+    try:
+        compile_pipeline(fit_pipeline(X, Y * 2)).save(model_path)
+        api.registry.load()
+        expected = api.registry.model.predict(X.head(1))[0]
+        assert client.post("/predict", json=car).json()["prediction"] == f"{round(float(expected))} euros"
+        # The listeners after the failing one still ran (model info of /metrics)
+        model_info = [sample.value for family in text_string_to_metric_families(client.get("/metrics").text)
+                      for sample in family.samples if sample.name == "getaround_model_info"]
+        assert model_info == [api.registry.live.loaded_at]
+    finally:
+        api.registry.listeners.remove(failing)
+        with open(model_path, "wb") as f:
+            f.write(original)
+        api.registry.load()
+
+    # A locked sqlite file doesn't make the swap fail
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = SqlitePredictionCache(os.path.join(tmp, "predictions.sqlite"), timeout=0.01)
+        other = sqlite3.connect(os.path.join(tmp, "predictions.sqlite"), isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+        try:
+            cache.clear()
+        finally:
+            other.execute("ROLLBACK")
+            other.close()
+        assert cache.lock_errors == 1
+    print("Prediction cache cleared on model swaps")
+
+
+#### Test jobs
+def test_jobs():
+    import io
+    import time
+    import shutil
+    import numpy as np
+    from jobs import JobManager
+
+    api, client = local_api()
+    X, _ = sample_cars()
+    expected = api.registry.model.predict(X)
+
+    def wait(status):
+        deadline = time.time() + 30
+        while status() in ("queued", "running"):
+            assert time.time() < deadline, "job didn't finish"
+            time.sleep(0.05)
+        return status()
+
+    # Submitted, polled, downloaded
+    r = client.post("/jobs", files={"file": ("cars.csv", X.to_csv(index=False), "text/csv")})
+    assert r.status_code == 202, r.text
+    job_id = r.json()["id"]
+    assert wait(lambda: client.get(f"/jobs/{job_id}").json()["status"]) == "done"
+    assert client.get(f"/jobs/{job_id}").json()["rows_done"] == len(X)
+    results = pd.read_csv(io.StringIO(client.get(f"/jobs/{job_id}/results").text))
+    np.testing.assert_allclose(results["prediction"], expected, rtol=1e-9, atol=1e-6)
+    assert client.get("/jobs/" + "0" * 32).status_code == 404
+    assert client.get("/jobs/" + "0" * 32 + "/results").status_code == 404
+
+    with tempfile.TemporaryDirectory() as spool:
+        # Jobs left by a stopped worker: queued, and running with a claim not updated since
+        stopped = JobManager(spool, get_model=lambda: api.registry.model, chunksize=7)
+        queued = stopped.submit(io.BytesIO(X.to_csv(index=False).encode()), "cars.csv", "text/csv")["id"]
+        running = stopped.submit(io.BytesIO(X.to_csv(index=False).encode()), "cars.csv", "text/csv")["id"]
+        stopped._write_status(running, status="running", rows_done=7)
+        with open(os.path.join(spool, running, "claim"), "w") as f:
+            f.write(str(os.getpid()))
+        os.utime(os.path.join(spool, running, "claim"), (time.time() - 3600, time.time() - 3600))
+        # And one deleted while in the queue: the worker must keep going
+        deleted = stopped.submit(io.BytesIO(X.to_csv(index=False).encode()), "cars.csv", "text/csv")["id"]
+
+        restarted = JobManager(spool, get_model=lambda: api.registry.model, max_concurrent=1, chunksize=7)
+        restarted._queue.put(deleted)
+        shutil.rmtree(os.path.join(spool, deleted))
+        restarted.start()
+        try:
+            for job_id in (queued, running):
+                assert wait(lambda: restarted.status(job_id)["status"]) == "done", restarted.status(job_id)
+                results = pd.read_csv(restarted.result_path(job_id))
+                np.testing.assert_allclose(results["prediction"], expected, rtol=1e-9, atol=1e-6)
+            assert restarted.status(deleted) is None
+            assert all(thread.is_alive() for thread in restarted._threads)
+        finally:
+            restarted.stop()
+    print("Jobs run, resumed after a restart, deleted ones skipped")
+
+
+#### Test price grid
+def test_predict_grid():
+    import io
+    import numpy as np
+
+    api, client = local_api()
+    base = {"model_key": "Renault", "engine_power": 110, "fuel": "diesel", "car_type": "sedan"}
+    car = {**api.PredictionFeatures().model_dump(), **base}
+
+    # Refused: unknown field, booleans, invalid text value, ranges with no end, too many points
+    for sweep in (
+        {"color": {"values": ["red"]}},
+        {"mileage": {"values": [True, 10000]}},
+        {"mileage": {"start": 0, "stop": True, "step": 1000}},
+        {"fuel": {"values": ["diesel", "water"]}},
+        {"mileage": {"start": 0, "stop": 1e308, "step": 1e-300}},
+        {"mileage": {"start": 0, "stop": 999999, "step": 1}, "engine_power": {"values": [100, 200]}},
+    ):
+        r = client.post("/predict-grid", json={"base": base, "sweep": sweep})
+        assert r.status_code == 422, (sweep, r.text)
+
+    # Small grid: one JSON list
+    r = client.post("/predict-grid", json={"base": base, "sweep": {"mileage": {"values": [0, 50000]}, "fuel": {"values": ["diesel", "petrol"]}}})
+    assert r.status_code == 200, r.text
+    points = pd.DataFrame(r.json())
+    assert points[["mileage", "fuel"]].values.tolist() == [[0, "diesel"], [0, "petrol"], [50000, "diesel"], [50000, "petrol"]]
+    expected = api.registry.model.predict_records([{**car, "mileage": m, "fuel": f} for m, f in points[["mileage", "fuel"]].values])
+    np.testing.assert_allclose(points["prediction"], expected, rtol=1e-9, atol=1e-6)
+
+    # Over GRID_STREAM_THRESHOLD points: streamed as ndjson
+    r = client.post("/predict-grid", json={"base": base, "sweep": {"mileage": {"start": 0, "stop": api.GRID_STREAM_THRESHOLD, "step": 1}}})
+    assert r.status_code == 200, r.text
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    points = pd.read_json(io.StringIO(r.text), lines=True)
+    assert len(points) == api.GRID_STREAM_THRESHOLD + 1
+    assert points["mileage"].tolist() == list(range(api.GRID_STREAM_THRESHOLD + 1))
+    expected = api.registry.model.predict_records([{**car, "mileage": float(m)} for m in points["mileage"]])
+    np.testing.assert_allclose(points["prediction"], expected, rtol=1e-9, atol=1e-6)
+    print("Grid validated, large grids streamed")
+
+
+#### Test request metrics
+def test_request_metrics():
+    from prometheus_client.parser import text_string_to_metric_families
+
+    api, client = local_api()
+
+    def requests_served():
+        counts = {}
+        for family in text_string_to_metric_families(client.get("/metrics").text):
+            for sample in family.samples:
+                if sample.name == "getaround_requests_total":
+                    counts[sample.labels["endpoint"], sample.labels["status"]] = sample.value
+        return counts
+
+    before = requests_served()
+    # Refused by the validation, unknown job
+    assert client.post("/predict", json={"mileage": "a lot"}).status_code == 422
+    assert client.get("/jobs/" + "0" * 32).status_code == 404
+    after = requests_served()
+    assert after[("/predict", "422")] - before.get(("/predict", "422"), 0) == 1
+    assert after[("/jobs/{job_id}", "404")] - before.get(("/jobs/{job_id}", "404"), 0) == 1
+    print("Requests counted with the status they were answered with")
+
 
 #### Prepare test data 
 def prepare_test_file():
@@ -76,4 +416,17 @@ def prepare_test_file():
     df.to_csv("data/test_data.csv", index=False)
     return "Done"
 
-prepare_test_file()
\ No newline at end of file
+
+# The calls to the deployed API and the S3 dataset only run as a script
+if __name__ == "__main__":
+    test_prediction()
+    test_batch()
+    test_compiled_scorer()
+    test_batched_predictions()
+    test_overloaded()
+    test_streamed_batch()
+    test_cache_cleared_on_swap()
+    test_jobs()
+    test_predict_grid()
+    test_request_metrics()
+    prepare_test_file()
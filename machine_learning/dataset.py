@@ -0,0 +1,177 @@
+"""
+Local, content-addressed cache of the training dataset.
+
+The csv is downloaded once, its sha256 checked (`DATASET_SHA256`, when set) and stored as typed
+Parquet (text columns as categoricals, boolean features as booleans) under
+`DATASET_CACHE_DIR/<sha256 of the csv>.parquet`. `index.json` maps the dataset urls to those files,
+so training runs read the cache and work offline, and the hash logged with each run identifies
+the exact data behind the model. The csv is converted and can be read back (`iter_dataset`)
+chunk by chunk, so datasets larger than memory are fine.
+
+    python dataset.py fetch          # download DATASET_URL into the cache
+    python dataset.py list
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import urllib.request
+
+import pandas as pd
+
+DATASET_URL = os.environ.get("DATASET_URL", "https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv")
+CACHE_DIR = os.environ.get("DATASET_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_cache"))
+
+BOOLEAN_FEATURES = ['private_parking_available', 'has_gps', 'has_air_conditioning', 'automatic_car', 'has_getaround_connect', 'has_speed_regulator', 'winter_tires']
+
+
+class ChecksumMismatch(Exception):
+    """The downloaded / cached data isn't the expected one."""
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def typed(df):
+    """Text columns as categoricals, boolean features as booleans."""
+    for column in df.columns:
+        if column in BOOLEAN_FEATURES:
+            df[column] = df[column].isin([True, "True", "true", "yes"])
+        elif df[column].dtype == object or str(df[column].dtype) in ("str", "string"):
+            df[column] = df[column].astype("category")
+    return df
+
+
+def csv_to_parquet(csv_path, parquet_path, chunksize=100000):
+    """Convert chunk by chunk, text columns stored as dictionaries (read back as categoricals). Returns the row count."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    rows = 0
+    try:
+        for chunk in pd.read_csv(csv_path, index_col=0, chunksize=chunksize):
+            table = pa.Table.from_pandas(typed(chunk))
+            # Same dictionary type in every chunk, whatever its number of categories
+            table = table.cast(pa.schema([
+                field.with_type(pa.dictionary(pa.int32(), pa.string())) if pa.types.is_dictionary(field.type) else field
+                for field in table.schema
+            ], metadata=table.schema.metadata))
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, table.schema)
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+class DatasetCache:
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def entries(self):
+        return self._read_index()
+
+    def path(self, sha256):
+        return os.path.join(self.cache_dir, sha256 + ".parquet")
+
+    def fetch(self, url, sha256=None):
+        """
+        Download `url`, store it as Parquet and return the sha256 of the csv. A download that
+        isn't the expected `sha256` raises `ChecksumMismatch` and leaves the cache untouched.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".download-", dir=self.cache_dir)
+        try:
+            csv_path = os.path.join(tmp_dir, "dataset.csv")
+            with urllib.request.urlopen(url) as response, open(csv_path, "wb") as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+            fetched = file_hash(csv_path)
+            if sha256 is not None and fetched != sha256:
+                raise ChecksumMismatch(f"{url} has sha256 {fetched}, expected {sha256}")
+            tmp_path = os.path.join(tmp_dir, "dataset.parquet")
+            rows = csv_to_parquet(csv_path, tmp_path)
+            os.replace(tmp_path, self.path(fetched))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        index = self._read_index()
+        index[url] = {"sha256": fetched, "rows": rows, "cached_at": time.time()}
+        self._write_index(index)
+        return fetched
+
+    def resolve(self, url, sha256=None):
+        """sha256 of the cached copy of `url`, downloaded only when it isn't cached (or not the expected one)."""
+        entry = self._read_index().get(url)
+        if entry is not None and os.path.exists(self.path(entry["sha256"])) and sha256 in (None, entry["sha256"]):
+            return entry["sha256"]
+        if sha256 is not None and os.path.exists(self.path(sha256)):
+            # Same content cached from another url
+            return sha256
+        return self.fetch(url, sha256)
+
+
+def load_dataset(url=DATASET_URL, sha256=None, cache=None):
+    """(DataFrame, sha256 of the csv) of the dataset at `url`, read from the local cache."""
+    cache = cache if cache is not None else DatasetCache()
+    sha256 = cache.resolve(url, sha256 if sha256 is not None else os.environ.get("DATASET_SHA256"))
+    return pd.read_parquet(cache.path(sha256)), sha256
+
+
+def iter_dataset(url=DATASET_URL, sha256=None, cache=None, chunksize=100000):
+    """(chunks, sha256 of the csv): chunks is a function yielding DataFrames of at most `chunksize` rows."""
+    import pyarrow.parquet as pq
+
+    cache = cache if cache is not None else DatasetCache()
+    sha256 = cache.resolve(url, sha256 if sha256 is not None else os.environ.get("DATASET_SHA256"))
+
+    def chunks():
+        # Each call reads the file again (one pass / epoch)
+        parquet_file = pq.ParquetFile(cache.path(sha256))
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+
+    return chunks, sha256
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local dataset cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fetch_parser = subparsers.add_parser("fetch", help="Download a dataset into the cache")
+    fetch_parser.add_argument("url", nargs="?", default=DATASET_URL)
+    fetch_parser.add_argument("--sha256", help="Expected sha256 of the csv")
+    subparsers.add_parser("list", help="List cached datasets")
+    args = parser.parse_args()
+
+    cache = DatasetCache()
+    if args.command == "fetch":
+        df, sha256 = load_dataset(args.url, args.sha256, cache)
+        print(f"{args.url}: {len(df)} rows, sha256 {sha256}")
+    else:
+        json.dump(cache.entries(), sys.stdout, indent=2, sort_keys=True)
+        print()
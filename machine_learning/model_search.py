@@ -0,0 +1,141 @@
+"""
+Cross-validated search over candidate regressors (`python train.py --mode search`).
+
+The preprocessing is fitted once per fold and the transformed folds are shared by every
+candidate; candidates x folds are then fitted in parallel on all cores (process pool). Each
+candidate is logged as a nested MLflow run with its cross-validated error, fit time, predict
+latency per row and model size, so the model is chosen for the serving latency budget as well as
+for its accuracy.
+
+The search space is a JSON file mapping a candidate name to the estimator class and a grid of
+hyperparameters (see `SEARCH_SPACE`):
+
+    {"ridge": {"estimator": "sklearn.linear_model.Ridge", "params": {"alpha": [0.1, 1, 10]}}}
+"""
+import os
+import json
+import time
+import pickle
+import itertools
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import KFold
+
+SEARCH_SPACE = {
+    "linear_regression": {"estimator": "sklearn.linear_model.LinearRegression", "params": {}},
+    "ridge": {"estimator": "sklearn.linear_model.Ridge", "params": {"alpha": [0.1, 1.0, 10.0, 100.0]}},
+    "lasso": {"estimator": "sklearn.linear_model.Lasso", "params": {"alpha": [0.01, 0.1, 1.0], "max_iter": [5000]}},
+    "elastic_net": {"estimator": "sklearn.linear_model.ElasticNet", "params": {"alpha": [0.01, 0.1], "l1_ratio": [0.2, 0.5, 0.8], "max_iter": [5000]}},
+    "gradient_boosting": {"estimator": "sklearn.ensemble.GradientBoostingRegressor", "params": {"n_estimators": [100, 300], "max_depth": [3, 5], "learning_rate": [0.05, 0.1], "random_state": [0]}},
+    "random_forest": {"estimator": "sklearn.ensemble.RandomForestRegressor", "params": {"n_estimators": [100, 300], "min_samples_leaf": [1, 5], "random_state": [0]}},
+    "extra_trees": {"estimator": "sklearn.ensemble.ExtraTreesRegressor", "params": {"n_estimators": [200], "min_samples_leaf": [1, 5], "random_state": [0]}},
+}
+
+# Transformed folds, set once in each worker of the pool
+_folds = None
+
+
+def load_search_space(path=None):
+    if path is None:
+        return SEARCH_SPACE
+    with open(path) as f:
+        return json.load(f)
+
+
+def make_estimator(class_path, params):
+    module, name = class_path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)(**params)
+
+
+def candidates(search_space):
+    """(name, estimator class path, params) of every combination of hyperparameters."""
+    for name, candidate in search_space.items():
+        grid = candidate.get("params", {})
+        for values in itertools.product(*grid.values()):
+            yield name, candidate["estimator"], dict(zip(grid.keys(), values))
+
+
+def transform_folds(preprocessor, X, Y, n_splits=5):
+    """(X_train, y_train, X_valid, y_valid) of each fold, the preprocessor fitted on the fold's train part."""
+    folds = []
+    for train_index, valid_index in KFold(n_splits=n_splits, shuffle=True, random_state=0).split(X):
+        fold_preprocessor = clone(preprocessor)
+        X_train = fold_preprocessor.fit_transform(X.iloc[train_index])
+        X_valid = fold_preprocessor.transform(X.iloc[valid_index])
+        folds.append((X_train, Y.iloc[train_index].to_numpy(), X_valid, Y.iloc[valid_index].to_numpy()))
+    return folds
+
+
+def _init_worker(folds):
+    global _folds
+    _folds = folds
+
+
+def evaluate(class_path, params, fold):
+    """Metrics of one candidate on one fold."""
+    X_train, y_train, X_valid, y_valid = _folds[fold]
+    estimator = make_estimator(class_path, params)
+    started = time.perf_counter()
+    estimator.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    predictions = estimator.predict(X_valid)
+    predict_seconds = time.perf_counter() - started
+    # Latency of a single car, as /predict sees it
+    single = []
+    for i in range(min(20, X_valid.shape[0])):
+        started = time.perf_counter()
+        estimator.predict(X_valid[i:i + 1])
+        single.append(time.perf_counter() - started)
+
+    errors = predictions - y_valid
+    return {
+        "rmse": float(np.sqrt(np.mean(errors ** 2))),
+        "mae": float(np.mean(np.abs(errors))),
+        "r2": float(1 - np.sum(errors ** 2) / np.sum((y_valid - y_valid.mean()) ** 2)),
+        "fit_seconds": fit_seconds,
+        "predict_us_per_row": predict_seconds / len(y_valid) * 1e6,
+        "predict_single_ms": float(np.median(single)) * 1000,
+        "model_size_bytes": len(pickle.dumps(estimator)),
+    }
+
+
+def search(preprocessor, X, Y, search_space=SEARCH_SPACE, n_splits=5, max_workers=None):
+    """Cross-validated metrics (mean over the folds) of every candidate, best first."""
+    folds = transform_folds(preprocessor, X, Y, n_splits)
+    configurations = list(candidates(search_space))
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_worker, initargs=(folds,)) as pool:
+        futures = [
+            [pool.submit(evaluate, class_path, params, fold) for fold in range(n_splits)]
+            for name, class_path, params in configurations
+        ]
+        results = []
+        for (name, class_path, params), fold_futures in zip(configurations, futures):
+            fold_metrics = [future.result() for future in fold_futures]
+            metrics = {key: float(np.mean([m[key] for m in fold_metrics])) for key in fold_metrics[0]}
+            metrics["rmse_std"] = float(np.std([m["rmse"] for m in fold_metrics]))
+            results.append({"name": name, "estimator": class_path, "params": params, "metrics": metrics})
+    return sorted(results, key=lambda result: result["metrics"]["rmse"])
+
+
+def select(results, latency_budget_ms=None):
+    """Most accurate candidate whose single row latency fits the budget."""
+    eligible = [r for r in results if latency_budget_ms is None or r["metrics"]["predict_single_ms"] <= latency_budget_ms]
+    if not eligible:
+        raise ValueError(f"No candidate predicts a row within {latency_budget_ms} ms")
+    return eligible[0]
+
+
+def log_results(results):
+    """One nested MLflow run per candidate."""
+    import mlflow
+
+    for result in results:
+        with mlflow.start_run(run_name=result["name"], nested=True):
+            mlflow.log_param("estimator", result["estimator"])
+            mlflow.log_params(result["params"])
+            mlflow.log_metrics({f"cv_{key}": value for key, value in result["metrics"].items()})
@@ -0,0 +1,106 @@
+"""
+Profiling of the training stages (loading, preprocessing, regressor fit, evaluation, logging).
+
+Each stage records its wall time, CPU time, peak resident memory and rows/sec. The peak is the
+high-water mark of the process RSS during the stage (reset at the start of each stage through
+/proc/self/clear_refs on Linux, else the peak since the process started).
+
+They are logged as MLflow metrics (`profile_<stage>_<measure>`) and written to a JSON report, so
+the training cost can be followed as the dataset grows.
+
+    profiler = StageProfiler()
+    with profiler.stage("load") as stage:
+        df = load()
+        stage["rows"] = len(df)
+    profiler.log_mlflow()
+    profiler.write("training_profile.json")
+"""
+import os
+import json
+import time
+import platform
+import resource
+from contextlib import contextmanager
+
+
+def _cpu_seconds():
+    """CPU time of this process and its finished children (e.g. the model search pool)."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _memory_mb(field):
+    """`VmRSS` (current) or `VmHWM` (peak) resident memory of this process in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if platform.system() != "Darwin" else 1024 ** 2)
+
+
+class StageProfiler:
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """Profile the block. `rows` can also be set in the block: `stage["rows"] = n`."""
+        record = {"stage": name, "rows": rows}
+        _reset_peak_rss()
+        record["start_memory_mb"] = _memory_mb("VmRSS")
+        wall_started, cpu_started = time.perf_counter(), _cpu_seconds()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall_started
+            # All threads / processes, can exceed the wall time
+            record["cpu_seconds"] = _cpu_seconds() - cpu_started
+            record["peak_memory_mb"] = _memory_mb("VmHWM")
+            if record["rows"]:
+                record["rows_per_second"] = record["rows"] / record["wall_seconds"] if record["wall_seconds"] > 0 else None
+            self.stages.append(record)
+            print(f"[{name}] {record['wall_seconds']:.2f}s wall, {record['cpu_seconds']:.2f}s cpu, {record['peak_memory_mb']:.0f} MB peak"
+                  + (f", {record['rows_per_second']:.0f} rows/s" if record.get("rows_per_second") else ""))
+
+    def metrics(self):
+        metrics = {}
+        for record in self.stages:
+            for key in ("wall_seconds", "cpu_seconds", "peak_memory_mb", "rows_per_second"):
+                if record.get(key) is not None:
+                    metrics[f"profile_{record['stage']}_{key}"] = record[key]
+        return metrics
+
+    def report(self):
+        return {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "stages": self.stages,
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+    def log_mlflow(self, report_path=None):
+        """Log the stages as metrics of the active run, and the JSON report as an artifact."""
+        import mlflow
+
+        mlflow.log_metrics(self.metrics())
+        if report_path is not None:
+            mlflow.log_artifact(self.write(report_path))
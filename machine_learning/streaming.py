@@ -0,0 +1,140 @@
+"""
+Out-of-core training (`python train.py --mode stream`): the dataset is read chunk by chunk, so the
+memory used depends on the chunk size, not on the size of the dataset.
+
+1. a first pass fits the StandardScaler (`partial_fit`) and collects the categories of each
+   categorical column
+2. each next pass (epoch) fits an `SGDRegressor` with `partial_fit`, chunk by chunk
+
+A stable hash of the row number keeps `holdout` of the rows out of training, they are scored
+after the last epoch. The result is the same Pipeline(Preprocessing, Regressor) as the batch
+training, so it is logged / served as the usual `getaround_project` artifact.
+"""
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import SGDRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from dataset import BOOLEAN_FEATURES
+
+TARGET = "rental_price_per_day"
+
+
+def prepare(chunk):
+    """Features / target of a chunk, boolean features as "yes" / "no" like the API sends them."""
+    chunk = chunk.copy()
+    for column in BOOLEAN_FEATURES:
+        if column in chunk:
+            chunk[column] = np.where(chunk[column].isin([True, "True", "true", "yes"]), "yes", "no")
+    return chunk.drop(columns=TARGET), chunk[TARGET].to_numpy(dtype=np.float64)
+
+
+def is_holdout(start, length, holdout):
+    """Rows kept for evaluation: a hash of their row number, so the split is the same every pass."""
+    rows = np.arange(start, start + length, dtype=np.uint64)
+    return pd.util.hash_array(rows) % 10000 < holdout * 10000
+
+
+def numeric_columns(X):
+    return [column for column, dtype in X.dtypes.items() if "float" in str(dtype) or "int" in str(dtype)]
+
+
+def fit_statistics(chunks, holdout):
+    """Scaler fitted incrementally on the training rows, categories of each categorical column, a sample of rows."""
+    scaler = StandardScaler()
+    categories = {}
+    numeric_features = None
+    sample = None
+    start = 0
+    for chunk in chunks():
+        X, _ = prepare(chunk)
+        train = ~is_holdout(start, len(X), holdout)
+        start += len(X)
+        if numeric_features is None:
+            numeric_features = numeric_columns(X)
+            sample = X.head(1)
+        if train.any():
+            scaler.partial_fit(X.loc[train, numeric_features])
+        for column in X.columns.difference(numeric_features):
+            values = X[column].dropna()
+            categories.setdefault(column, set()).update(values.unique().tolist())
+    return scaler, {column: sorted(values) for column, values in categories.items()}, numeric_features, sample
+
+
+def build_preprocessor(scaler, categories, numeric_features, sample):
+    """ColumnTransformer equal to the one the batch training would fit on the whole dataset."""
+    categorical_features = list(categories)
+    preprocessor = ColumnTransformer(transformers=[
+        ("num", StandardScaler(), numeric_features),
+        ("cat", OneHotEncoder(categories=[categories[c] for c in categorical_features], drop='first', handle_unknown='ignore'), categorical_features),
+    ])
+    # Fitted on one row for its bookkeeping (the encoder's categories are explicit), then the
+    # scaler statistics of the whole dataset are swapped in
+    preprocessor.fit(sample[numeric_features + categorical_features])
+    preprocessor.named_transformers_["num"].__dict__.update(scaler.__dict__)
+    return preprocessor
+
+
+def train_streaming(chunks, holdout=0.1, epochs=5, random_state=0, profiler=None):
+    """
+    Fit the pipeline on `chunks()` (a function yielding DataFrames, called once per pass).
+    Returns (pipeline, holdout metrics, a sample of the training features).
+    Each pass is a stage of `profiler` (a `profiling.StageProfiler`), when given.
+    """
+    def stage(name):
+        return profiler.stage(name) if profiler is not None else nullcontext({})
+
+    with stage("preprocessing_fit") as profiled:
+        scaler, categories, numeric_features, sample = fit_statistics(chunks, holdout)
+        preprocessor = build_preprocessor(scaler, categories, numeric_features, sample)
+        profiled["rows"] = int(scaler.n_samples_seen_)
+    regressor = SGDRegressor(random_state=random_state)
+    rng = np.random.default_rng(random_state)
+
+    with stage("regressor_fit") as profiled:
+        rows = 0
+        for epoch in range(epochs):
+            start = 0
+            for chunk in chunks():
+                X, y = prepare(chunk)
+                train = ~is_holdout(start, len(X), holdout)
+                start += len(X)
+                if not train.any():
+                    continue
+                # Shuffled within the chunk, SGD doesn't like long runs of similar rows
+                order = rng.permutation(np.flatnonzero(train))
+                regressor.partial_fit(preprocessor.transform(X.iloc[order]), y[order])
+                rows += len(order)
+        profiled["rows"] = rows
+
+    # Holdout metrics accumulated chunk by chunk
+    with stage("evaluation") as profiled:
+        count, squared, absolute, total, total_squared = 0, 0.0, 0.0, 0.0, 0.0
+        start = 0
+        for chunk in chunks():
+            X, y = prepare(chunk)
+            test = is_holdout(start, len(X), holdout)
+            start += len(X)
+            if not test.any():
+                continue
+            errors = regressor.predict(preprocessor.transform(X[test])) - y[test]
+            count += int(test.sum())
+            squared += float(np.sum(errors ** 2))
+            absolute += float(np.sum(np.abs(errors)))
+            total += float(np.sum(y[test]))
+            total_squared += float(np.sum(y[test] ** 2))
+        profiled["rows"] = count
+    metrics = {"holdout_rows": count}
+    if count:
+        metrics.update(
+            holdout_rmse=float(np.sqrt(squared / count)),
+            holdout_mae=absolute / count,
+            holdout_r2=1 - squared / (total_squared - total ** 2 / count) if count > 1 else 0.0,
+        )
+
+    pipeline = Pipeline(steps=[("Preprocessing", preprocessor), ("Regressor", regressor)])
+    return pipeline, metrics, sample
@@ -8,6 +8,20 @@ from sklearn.preprocessing import OneHotEncoder, StandardScaler
 from sklearn.compose import ColumnTransformer
 from sklearn.linear_model import LinearRegression
 from sklearn.pipeline import Pipeline
+from dataset import DATASET_URL, iter_dataset, load_dataset
+from model_search import load_search_space, log_results, make_estimator, search, select
+from streaming import train_streaming
+from profiling import StageProfiler
+
+parser = argparse.ArgumentParser(description="Train the rental price model")
+parser.add_argument("--mode", choices=["fit", "search", "stream"], default="fit", help="fit a LinearRegression, search over candidate regressors, or train out-of-core")
+parser.add_argument("--search-space", help="JSON file of candidates / hyperparameters (see model_search.py)")
+parser.add_argument("--folds", type=int, default=5)
+parser.add_argument("--latency-budget-ms", type=float, help="Only keep candidates predicting a row within this time")
+parser.add_argument("--chunksize", type=int, default=100000, help="Rows read at once in stream mode")
+parser.add_argument("--epochs", type=int, default=5, help="Passes over the data in stream mode")
+parser.add_argument("--profile-report", default="training_profile.json", help="JSON report of the time / memory taken by each stage")
+args = parser.parse_args()
 
 # Set tracking URI to your Heroku application
 mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
@@ -22,62 +36,112 @@ run = client.create_run(experiment.experiment_id)
 
 print("training model...")
 
-# Call mlflow autolog
-mlflow.sklearn.autolog(log_models=False) # We won't log models right away
-
-# Load dataset
-df = pd.read_csv('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv', index_col=0)
-df[['private_parking_available', 'has_gps','has_air_conditioning', 'automatic_car', 'has_getaround_connect', 'has_speed_regulator', 'winter_tires']] = df[['private_parking_available', 'has_gps','has_air_conditioning', 'automatic_car', 'has_getaround_connect', 'has_speed_regulator', 'winter_tires']].apply(lambda x: "yes" if True else "no")
-
-# Split dataset into X features and Target variable
-target_variable = "rental_price_per_day"
-
-X = df.drop(target_variable, axis=1)
-Y = df.loc[:, target_variable]
-
-# Automatically detect names of numeric/categorical columns
-numeric_features = []
-categorical_features = []
-for i,t in X.dtypes.items():
-    if ('float' in str(t)) or ('int' in str(t)) :
-        numeric_features.append(i)
-    else :
-        categorical_features.append(i)
-
-# Separate train and test sets
-X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.1, random_state=0)
-
-# StandardScaler to scale data (i.e apply Z-score) - OneHotEncoder to encode categorical variables
-numeric_transformer = StandardScaler()
-categorical_transformer = OneHotEncoder(drop='first', handle_unknown='ignore')
-
-# Use ColumnTransformer to make a preprocessor object that describes all the treatments to be done
-preprocessor = ColumnTransformer(
-    transformers=[
-        ("num", numeric_transformer, numeric_features),
-        ("cat", categorical_transformer, categorical_features),
-    ])
-
-# Pipeline 
-model = Pipeline(steps=[
-    ("Preprocessing", preprocessor),
-    ("Regressor",LinearRegression())
-], verbose=True)
-
-
-# Log experiment to MLFlow
-with mlflow.start_run(run_id = run.info.run_id) as run:
-    # Instanciate and fit the model 
-    model.fit(X_train, Y_train)
-    predictions = model.predict(X_train)
-        
-    # Log model seperately to have more flexibility on setup 
-    mlflow.sklearn.log_model(
-        sk_model=model,
-        artifact_path="getaround_project",
-        registered_model_name="api_linear_regression",
-        signature=infer_signature(X_train, predictions)
-    )
-
-    # Print results 
-    print("Done")
\ No newline at end of file
+# Call mlflow autolog (only for the plain fit: every fold / candidate / chunk would be logged to the run)
+mlflow.sklearn.autolog(log_models=False, disable=args.mode != "fit") # We won't log models right away
+
+# Wall / CPU time, peak memory and rows/sec of each stage, logged with the run (see profiling.py)
+profiler = StageProfiler()
+
+if args.mode == "stream":
+    # Out-of-core training: the dataset is read chunk by chunk, see streaming.py
+    with profiler.stage("data_loading"):
+        chunks, dataset_sha256 = iter_dataset(DATASET_URL, chunksize=args.chunksize)
+    with mlflow.start_run(run_id = run.info.run_id) as run:
+        mlflow.log_params({"dataset_url": DATASET_URL, "dataset_sha256": dataset_sha256, "chunksize": args.chunksize, "epochs": args.epochs})
+        model, metrics, sample = train_streaming(chunks, holdout=0.1, epochs=args.epochs, profiler=profiler)
+        mlflow.log_metrics(metrics)
+        with profiler.stage("artifact_logging"):
+            mlflow.sklearn.log_model(
+                sk_model=model,
+                artifact_path="getaround_project",
+                registered_model_name="api_linear_regression",
+                signature=infer_signature(sample, model.predict(sample))
+            )
+        profiler.log_mlflow(args.profile_report)
+        print("Done", metrics)
+
+else:
+    # Load dataset (downloaded once, then read from the local Parquet cache, see dataset.py)
+    with profiler.stage("data_loading") as stage:
+        df, dataset_sha256 = load_dataset(DATASET_URL)
+        stage["rows"] = len(df)
+    df[['private_parking_available', 'has_gps','has_air_conditioning', 'automatic_car', 'has_getaround_connect', 'has_speed_regulator', 'winter_tires']] = df[['private_parking_available', 'has_gps','has_air_conditioning', 'automatic_car', 'has_getaround_connect', 'has_speed_regulator', 'winter_tires']].apply(lambda x: "yes" if True else "no")
+
+    # Split dataset into X features and Target variable
+    target_variable = "rental_price_per_day"
+
+    X = df.drop(target_variable, axis=1)
+    Y = df.loc[:, target_variable]
+
+    # Automatically detect names of numeric/categorical columns
+    numeric_features = []
+    categorical_features = []
+    for i,t in X.dtypes.items():
+        if ('float' in str(t)) or ('int' in str(t)) :
+            numeric_features.append(i)
+        else :
+            categorical_features.append(i)
+
+    # Separate train and test sets
+    X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.1, random_state=0)
+
+    # StandardScaler to scale data (i.e apply Z-score) - OneHotEncoder to encode categorical variables
+    numeric_transformer = StandardScaler()
+    categorical_transformer = OneHotEncoder(drop='first', handle_unknown='ignore')
+
+    # Use ColumnTransformer to make a preprocessor object that describes all the treatments to be done
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ("num", numeric_transformer, numeric_features),
+            ("cat", categorical_transformer, categorical_features),
+        ])
+
+    # Log experiment to MLFlow
+    with mlflow.start_run(run_id = run.info.run_id) as run:
+        # Exact data behind the model
+        mlflow.log_params({"dataset_url": DATASET_URL, "dataset_sha256": dataset_sha256})
+
+        regressor = LinearRegression()
+        if args.mode == "search":
+            # Cross-validated candidates, each logged as a nested run, the best one is trained below
+            with profiler.stage("model_search", rows=len(X_train)):
+                results = search(preprocessor, X_train, Y_train, load_search_space(args.search_space), n_splits=args.folds)
+            log_results(results)
+            best = select(results, args.latency_budget_ms)
+            print(f"best candidate: {best['name']} {best['params']} {best['metrics']}")
+            mlflow.log_params({"regressor": best["estimator"], **{f"regressor_{key}": value for key, value in best["params"].items()}})
+            regressor = make_estimator(best["estimator"], best["params"])
+
+        # Fit the steps one by one to profile them, then assemble the (fitted) pipeline
+        with profiler.stage("preprocessing_fit_transform", rows=len(X_train)):
+            X_train_transformed = preprocessor.fit_transform(X_train)
+        with profiler.stage("regressor_fit", rows=len(X_train)):
+            regressor.fit(X_train_transformed, Y_train)
+
+        # Pipeline 
+        model = Pipeline(steps=[
+            ("Preprocessing", preprocessor),
+            ("Regressor", regressor)
+        ], verbose=True)
+        predictions = model.predict(X_train)
+
+        with profiler.stage("evaluation", rows=len(X_test)):
+            errors = model.predict(X_test) - Y_test
+            mlflow.log_metrics({
+                "test_rmse": float((errors ** 2).mean() ** 0.5),
+                "test_mae": float(errors.abs().mean()),
+                "test_r2": float(1 - (errors ** 2).sum() / ((Y_test - Y_test.mean()) ** 2).sum()),
+            })
+
+        # Log model seperately to have more flexibility on setup 
+        with profiler.stage("artifact_logging"):
+            mlflow.sklearn.log_model(
+                sk_model=model,
+                artifact_path="getaround_project",
+                registered_model_name="api_linear_regression",
+                signature=infer_signature(X_train, predictions)
+            )
+        profiler.log_mlflow(args.profile_report)
+
+        # Print results 
+        print("Done")
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""
+Derived frames and headline numbers of the dashboard, computed with vectorized operations.
+
+Everything here is a pure function of the input frames: `app.py` caches `compute_analytics`
+per data version, so widget interactions never recompute it. The threshold simulator reads the
+cell of the slider values in `threshold_grid`, computed once for every pair of thresholds.
+"""
+import numpy as np
+import pandas as pd
+
+# A second user waiting at least that long (minutes) is considered delayed
+WAITING_THRESHOLD = 10
+# Delays over 12 hours (either way) are outliers
+MAX_DELAY = 720
+# Minimum delays between two rentals explored by the threshold simulator (minutes)
+THRESHOLDS = np.arange(0, 241, 5)
+
+
+def floats(values):
+    """float64 array of a column (missing values of nullable integer columns as NaN)."""
+    if isinstance(values, pd.Series):
+        return values.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.asarray(values, dtype=np.float64)
+
+
+def waiting_time(previous_delay, time_delta):
+    """Minutes the next user waits for the car: the delay of the previous rental beyond the time delta, 0 if none."""
+    return np.clip(floats(previous_delay) - floats(time_delta), 0, None)
+
+
+def impact_frame(df):
+    """Rentals following a previous one (within 12 hours) with the waiting time of their user."""
+    df_impact = df.dropna(subset=['previous_ended_rental_id', 'previous_delay_in_minutes'])
+    # Removing outliers (delay over or below 12 hours)
+    df_impact = df_impact[(df_impact['previous_delay_in_minutes'] <= MAX_DELAY) & (df_impact['previous_delay_in_minutes'] > -MAX_DELAY)].copy()
+    df_impact['waiting_time_second_user'] = waiting_time(df_impact['previous_delay_in_minutes'], df_impact['time_delta'])
+    df_impact['waiting_time'] = np.where(df_impact['waiting_time_second_user'] >= WAITING_THRESHOLD, "yes", "no")
+    return df_impact
+
+
+def hypothesis_frame(df_impact, mobile_threshold=90, connect_threshold=15):
+    """`df_impact` as if a minimum delay between rentals was enforced, depending on the previous checkin type."""
+    df_hypothesis = df_impact.copy()
+    minimum = np.select(
+        [df_hypothesis['previous_checkin_type'] == 'mobile', df_hypothesis['previous_checkin_type'] == 'connect'],
+        [mobile_threshold, connect_threshold],
+        default=-np.inf
+    )
+    # np.maximum keeps missing time deltas missing
+    df_hypothesis['new_time_delta'] = np.maximum(floats(df_hypothesis['time_delta']), minimum)
+    df_hypothesis['test_waiting_time_second_user'] = waiting_time(df_hypothesis['previous_delay_in_minutes'], df_hypothesis['new_time_delta'])
+    df_hypothesis['test_waiting_time'] = np.where(df_hypothesis['test_waiting_time_second_user'] > WAITING_THRESHOLD, "late", "on time")
+    return df_hypothesis
+
+
+def share(mask):
+    """Percentage of True in `mask`."""
+    mask = np.asarray(mask)
+    return float(mask.mean() * 100) if len(mask) else 0.0
+
+
+def mean_delta_frame(df_impact):
+    """Mean waiting time per time delta and previous checkin type (only where there is some waiting)."""
+    mean_delta = df_impact.groupby(['time_delta', 'previous_checkin_type'], observed=True)["waiting_time_second_user"].mean().reset_index()
+    mean_delta = mean_delta[mean_delta['waiting_time_second_user'] != 0]
+    mean_delta['waiting_time_second_user'] = mean_delta['waiting_time_second_user'].round()
+    return mean_delta
+
+
+def _threshold_sums(previous_delay, time_delta, delayed, thresholds, chunksize=65536):
+    """
+    For each threshold: rentals late for their user, total waiting time of the rentals in `delayed`
+    and rentals blocked (time delta under the threshold). Rows x thresholds are computed at once,
+    `chunksize` rows at a time.
+    """
+    late = np.zeros(len(thresholds), dtype=np.int64)
+    waiting_delayed = np.zeros(len(thresholds))
+    blocked = np.zeros(len(thresholds), dtype=np.int64)
+    for start in range(0, len(previous_delay), chunksize):
+        delay = previous_delay[start:start + chunksize, None]
+        delta = time_delta[start:start + chunksize, None]
+        waiting = waiting_time(delay, np.maximum(delta, thresholds[None, :]))
+        late += (waiting > WAITING_THRESHOLD).sum(axis=0)
+        waiting_delayed += np.nansum(waiting[delayed[start:start + chunksize]], axis=0)
+        blocked += (delta < thresholds[None, :]).sum(axis=0)
+    return late, waiting_delayed, blocked
+
+
+def threshold_grid(df_impact, mobile_thresholds=THRESHOLDS, connect_thresholds=THRESHOLDS):
+    """
+    Outcome of every (mobile, connect) pair of minimum delays. A rental only depends on the
+    threshold of its previous checkin type, so both types are swept separately and combined by
+    broadcasting: cell [i, j] is mobile_thresholds[i] x connect_thresholds[j].
+    """
+    mobile_thresholds = np.asarray(mobile_thresholds, dtype=np.float64)
+    connect_thresholds = np.asarray(connect_thresholds, dtype=np.float64)
+    previous_delay = floats(df_impact['previous_delay_in_minutes'])
+    time_delta = floats(df_impact['time_delta'])
+    previous_checkin = df_impact['previous_checkin_type'].to_numpy(dtype=object)
+    delayed = df_impact['waiting_time'].to_numpy() == "yes"
+
+    sums = {}
+    for checkin_type, thresholds in (("mobile", mobile_thresholds), ("connect", connect_thresholds)):
+        rows = previous_checkin == checkin_type
+        sums[checkin_type] = _threshold_sums(previous_delay[rows], time_delta[rows], delayed[rows], thresholds)
+    # Rentals after another checkin type aren't affected by the thresholds
+    others = ~np.isin(previous_checkin, ["mobile", "connect"])
+    other_late, other_waiting, _ = _threshold_sums(previous_delay[others], time_delta[others], delayed[others], np.array([-np.inf]))
+
+    (mobile_late, mobile_waiting, mobile_blocked), (connect_late, connect_waiting, connect_blocked) = sums["mobile"], sums["connect"]
+    late = mobile_late[:, None] + connect_late[None, :] + other_late[0]
+    waiting = mobile_waiting[:, None] + connect_waiting[None, :] + other_waiting[0]
+    return {
+        "mobile_thresholds": mobile_thresholds,
+        "connect_thresholds": connect_thresholds,
+        "late_share": late / max(len(df_impact), 1) * 100,
+        "mean_waiting": waiting / max(int(delayed.sum()), 1),
+        "blocked": mobile_blocked[:, None] + connect_blocked[None, :],
+    }
+
+
+def lookup_index(grid, mobile_threshold, connect_threshold):
+    """Cell of a threshold grid (`threshold_grid`, `revenue.revenue_grid`) for a pair of thresholds."""
+    return int(np.searchsorted(grid["mobile_thresholds"], mobile_threshold)), int(np.searchsorted(grid["connect_thresholds"], connect_threshold))
+
+
+def lookup(grid, mobile_threshold, connect_threshold):
+    """Metrics of one cell of `threshold_grid`."""
+    i, j = lookup_index(grid, mobile_threshold, connect_threshold)
+    return {key: float(grid[key][i, j]) for key in ("late_share", "mean_waiting", "blocked")}
+
+
+def compute_analytics(df, pricing, mobile_threshold=90, connect_threshold=15):
+    """Derived frames and headline metrics of the dashboard."""
+    df_impact = impact_frame(df)
+    df_hypothesis = hypothesis_frame(df_impact, mobile_threshold, connect_threshold)
+    delayed = df_impact['waiting_time'].to_numpy() == "yes"
+    df_delay = df_impact[delayed]
+    df_nodelay = df_impact[~delayed]
+
+    metrics = {
+        "cars": len(pricing),
+        "reservations": len(df),
+        "cancelled_share": share(df['state'] == "canceled"),
+        "mobile_share": share(df['checkin_type'] == "mobile"),
+        "late_share": share(df['is_late'] == "checkout late"),
+        "connect_mean_delay": float(df.loc[df['checkin_type'] == "connect", 'delay_in_minutes'].mean()),
+        "mobile_mean_delay": float(df.loc[df['checkin_type'] == "mobile", 'delay_in_minutes'].mean()),
+        "relevant_reservations": len(df_impact),
+        "delayed_impact": share(delayed),
+        "delay_mean": float(df_delay['waiting_time_second_user'].mean()),
+        "delay_time_delta_mean": float(df_delay['time_delta'].mean()),
+        "delayed_reservations": len(df_delay),
+        "late_hypothesis": share(df_hypothesis['test_waiting_time'] == "late"),
+        "mean_hypothesis": float(df_hypothesis.loc[delayed, 'test_waiting_time_second_user'].mean()),
+    }
+    return {
+        "df_impact": df_impact,
+        "df_delay": df_delay,
+        "df_nodelay": df_nodelay,
+        "df_hypothesis": df_hypothesis,
+        "mean_delta": mean_delta_frame(df_impact),
+        "threshold_grid": threshold_grid(df_impact),
+        "metrics": metrics,
+    }
@@ -4,6 +4,11 @@ import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
 import time
+import os
+from analytics import compute_analytics, lookup, lookup_index
+from chains import cascade_metrics, chain_frame
+from ingest import FLEET_CSV, STORE_DIR, read_store
+from revenue import fleet_prices, prices_index_path, revenue_grid
 
 ### Config
 st.set_page_config(
@@ -12,58 +17,126 @@ st.set_page_config(
     layout="wide"
 )
 
+# Charts are built from counts / proportions / bins computed here, the figures only carry the
+# aggregated values (not one entry per rental)
+def counts(dataframe, columns):
+    return dataframe.groupby(columns, observed=True).size().reset_index(name="count")
+
 def pie_eda(dataframe, column, title):
-    fig = px.pie(dataframe, names=column)
+    aggregated = counts(dataframe, [column])
+    fig = px.pie(aggregated, names=column, values="count")
     fig.update_layout(title=title, showlegend=False, title_x=0.3)
     fig.update_traces(textposition='inside', textinfo='percent+label')
     return fig
 
 def bar_eda(dataframe, column, group, title):
-    fig = px.bar(dataframe, x = column , color=group)
+    aggregated = counts(dataframe, [column, group])
+    fig = px.bar(aggregated, x = column, y = "count", color=group)
     fig.update_layout(title=title, title_x=0.3)
     fig.update_xaxes(title=None)
     return fig
 
 def histogram_eda(dataframe, column, title):
-    fig = px.histogram(dataframe[column], nbins = 10)
+    values = dataframe[column]
+    if pd.api.types.is_numeric_dtype(values):
+        # 10 bins, as px.histogram(nbins=10) would
+        frequencies, edges = np.histogram(values.dropna().to_numpy(dtype=np.float64), bins = 10)
+        aggregated = pd.DataFrame({column: (edges[:-1] + edges[1:]) / 2, "count": frequencies})
+    else:
+        aggregated = counts(dataframe, [column])
+    fig = px.bar(aggregated, x = column, y = "count")
     fig.update_layout(showlegend = False, title = title, title_x=0.3)
     fig.update_xaxes(title=None)
     return fig
 
 def display_probability(dataframe, column, target, title):
-    fig = px.histogram(
-        dataframe, 
+    # Probability of each value of `column` within each value of `target`
+    aggregated = counts(dataframe, [target, column])
+    aggregated["probability"] = aggregated["count"] / aggregated.groupby(target, observed=True)["count"].transform("sum")
+    fig = px.bar(
+        aggregated, 
         x=column, 
+        y="probability",
         color=target, 
         facet_row=target, 
-        histnorm='probability',
-        text_auto = True
+        text_auto = '.3f'
     )
     fig.update_layout(title=title, showlegend=False, title_x=0.1)
     fig.update_xaxes(title=None)
     return fig
     
-# Import data
-@st.cache_data
-def load_data(DATA):
+# Import data: the typed Arrow store written by ingest.py (memory-mapped, no network), else the csv files
+def data_source(name, csv):
+    path = os.path.join(STORE_DIR, f"{name}.arrow")
+    return path if os.path.exists(path) else csv
+
+def data_version(path):
+    # Changes whenever the file does, so everything derived from it is recomputed
+    if not os.path.exists(path):
+        return (path,)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+# cache_resource: one copy shared by every session (cache_data would copy the frames on each rerun)
+@st.cache_resource
+def load_data(version):
+    DATA = version[0]
+    if DATA.endswith(".arrow"):
+        return read_store(DATA)
     data = pd.read_csv(DATA)
     return data
 
-df = load_data('df.csv')
-pricing = load_data("https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv")
-
-df_impact = df.dropna(subset=['previous_ended_rental_id'])
-# Drop lines with missing values
-df_impact = df_impact.dropna(subset=['previous_delay_in_minutes'])
-# Removing outliers (delay over or below 12 hours)
-df_impact = df_impact[(df_impact['previous_delay_in_minutes'] <= 720) & (df_impact['previous_delay_in_minutes'] > -720)]
-# Adding features about the waiting time of the second user -> if the delay of the first reservation is higher than the time delta,
-# it means the second user had to wait for the car
-df_impact['waiting_time_second_user'] = df_impact['previous_delay_in_minutes'] - df_impact['time_delta']
-# 0 for all lines where the car for ontime for the second user
-df_impact['waiting_time_second_user'] = df_impact['waiting_time_second_user'].apply(lambda x: 0 if x <= 0 else x)
-# Create a simple column to have the information if the 2nd user had to wait for the car (considering delay as 10 minutes late)
-df_impact['waiting_time'] = df_impact['waiting_time_second_user'].apply(lambda x: "yes" if x >= 10 else "no") 
+# Derived frames (df_impact, df_hypothesis...) and metrics are computed once per data version, in a
+# vectorized way (see analytics.py).
+@st.cache_resource
+def load_analytics(rentals_version, fleet_version):
+    return compute_analytics(load_data(rentals_version), load_data(fleet_version))
+
+# Rental chains of each car and the delay cascades along them (see chains.py)
+@st.cache_resource
+def load_chains(rentals_version):
+    chains = chain_frame(load_data(rentals_version))
+    cascades = chains[(chains['cascade_hops'] == 0) & (chains['downstream_rentals'] > 0)]
+    fig = bar_eda(cascades, "downstream_rentals", "checkin_type", "Later rentals affected by a late checkout")
+    fig.update_xaxes(title="rentals affected", dtick=1)
+    return cascade_metrics(chains), fig
+
+# Fleet priced by the pricing model at ingest time (`python revenue.py`), only read here
+@st.cache_resource
+def load_revenue(rentals_version, fleet_version, prices_version):
+    fleet = load_data(fleet_version)
+    prices, source, warning = fleet_prices(fleet)
+    return revenue_grid(load_analytics(rentals_version, fleet_version)["df_impact"], fleet, prices), source, warning
+
+# Figures are built once per data version too
+@st.cache_resource
+def load_charts(rentals_version, fleet_version):
+    df = load_data(rentals_version)
+    analytics = load_analytics(rentals_version, fleet_version)
+    # Calculate the mean waiting time according to the checkin type chosen by the previous user
+    fig1 = px.histogram(analytics["mean_delta"], x = "time_delta", y = "waiting_time_second_user", color = "previous_checkin_type", histfunc='avg', text_auto=True)
+    # fig = px.bar(mean_delta, x = "time_delta", y = "waiting_time_second_user", color = "previous_checkin_type")
+    fig1.update_layout(title = "Average waiting time regarding time delta and previous checkin type", title_x=0.2)
+    return {
+        "state": pie_eda(df, "state", "Proportions of cancelled/ended reservations"),
+        "checkin_type": histogram_eda(df, "checkin_type", "Proportion of checkin_type"),
+        "is_late": pie_eda(df, "is_late", "Proportion of reservations with delays"),
+        "late_by_checkin_type": bar_eda(df, "checkin_type", "is_late", "Repartition of delays among the checkin types"),
+        "delay_state": pie_eda(analytics["df_delay"], "state", "State for delayed reservations - due to previous booking"),
+        "nodelay_state": pie_eda(analytics["df_nodelay"], "state", "State for reservations on time - no impact from previous booking"),
+        "previous_checkin_type": display_probability(analytics["df_impact"], "previous_checkin_type", "waiting_time", "Has the checkin type of the first reservation an impact on the waiting time of the second user ?"),
+        "mean_delta": fig1,
+    }
+
+rentals_version = data_version(data_source("rentals", 'df.csv'))
+fleet_version = data_version(data_source("fleet", FLEET_CSV))
+df = load_data(rentals_version)
+pricing = load_data(fleet_version)
+analytics = load_analytics(rentals_version, fleet_version)
+charts = load_charts(rentals_version, fleet_version)
+chain_metrics, cascades_chart = load_chains(rentals_version)
+revenue, prices_source, prices_warning = load_revenue(rentals_version, fleet_version, data_version(prices_index_path()))
+metrics = analytics["metrics"]
 
 
 ### App
@@ -98,15 +171,15 @@ st.header("GetAround fleet", divider='gray')
 col1, col2 = st.columns(2)
 
 with col1:
-    st.metric("Number of cars", len(pricing))
-    st.plotly_chart(pie_eda(df, "state", "Proportions of cancelled/ended reservations"), theme='streamlit', use_container_width=False)
-    st.write(f"{round((df['state'].value_counts(normalize=True) * 100)[1])}% of reservations are cancelled.")
+    st.metric("Number of cars", metrics["cars"])
+    st.plotly_chart(charts["state"], theme='streamlit', use_container_width=False)
+    st.write(f"{round(metrics['cancelled_share'])}% of reservations are cancelled.")
     
     
 with col2:
-    st.metric("Number of reservations", len(df))
-    st.plotly_chart(histogram_eda(df, "checkin_type", "Proportion of checkin_type"), theme="streamlit", use_container_width=False)
-    st.write(f"{round((df['checkin_type'].value_counts(normalize=True) * 100)[0])}% of reservations are checkout with the mobile option which seems to be the main choice of the clients.")
+    st.metric("Number of reservations", metrics["reservations"])
+    st.plotly_chart(charts["checkin_type"], theme="streamlit", use_container_width=False)
+    st.write(f"{round(metrics['mobile_share'])}% of reservations are checkout with the mobile option which seems to be the main choice of the clients.")
 
 
 st.write('')
@@ -124,22 +197,19 @@ st.markdown("""
 st.write('')
 
 # Check differences regarding delays for connect and mobile states
-df_connect = df[df['checkin_type'] == "connect"]
-df_mobile = df[df['checkin_type'] == "mobile"]
-
-connect_checkout = round(df_connect['delay_in_minutes'].mean())
-mobile_checkout = round(df_mobile['delay_in_minutes'].mean())
+connect_checkout = round(metrics["connect_mean_delay"])
+mobile_checkout = round(metrics["mobile_mean_delay"])
 
 col1, col2 = st.columns(2)
 
 with col1:
-    st.plotly_chart(pie_eda(df, "is_late", "Proportion of reservations with delays"), theme="streamlit", use_container_width=True)
-    st.write(f"{round((df['is_late'].value_counts(normalize=True) * 100)[1])}% of checkouts are done with delay.")
+    st.plotly_chart(charts["is_late"], theme="streamlit", use_container_width=True)
+    st.write(f"{round(metrics['late_share'])}% of checkouts are done with delay.")
     st.write('')
     st.metric("Usual delay for connected checkout", f"{connect_checkout} minutes")
 
 with col2:
-    st.plotly_chart(bar_eda(df, "checkin_type", "is_late", "Repartition of delays among the checkin types"), theme="streamlit", use_container_width=True)
+    st.plotly_chart(charts["late_by_checkin_type"], theme="streamlit", use_container_width=True)
     st.write('We can see that most of the delayed checkouts depend on mobile choice.')
     st.write('')
     st.metric("Usual delay for mobile checkout", f"{mobile_checkout} minutes")
@@ -157,24 +227,20 @@ st.markdown("""
 """)
 st.write('')
 
-# Divide data in two datasets (if the 2nd user has to wait for the car or not)
-df_delay = df_impact[df_impact['waiting_time'] == "yes"]
-df_nodelay = df_impact[df_impact['waiting_time'] == "no"]
-
 col1, col2, col3, col4 = st.columns(4)
 
 with col1:
-    st.metric("Number of relevant reservations", len(df_impact))
+    st.metric("Number of relevant reservations", metrics["relevant_reservations"])
     
 with col2:
-    delayed_impact = round((df_impact['waiting_time'].value_counts(normalize=True) * 100))[1]
+    delayed_impact = round(metrics["delayed_impact"])
     st.metric("Proportion of delayed reservations - due to previous booking", f"{delayed_impact}%")
 
 with col3:
-    st.metric("Average waiting time when the first reservation is late", f"{round(df_delay['waiting_time_second_user'].mean())} minutes")
+    st.metric("Average waiting time when the first reservation is late", f"{round(metrics['delay_mean'])} minutes")
 
 with col4:
-    st.metric(f"Time delta between the two reservations when the second is delayed", f"{round(df_delay['time_delta'].mean())} minutes")
+    st.metric(f"Time delta between the two reservations when the second is delayed", f"{round(metrics['delay_time_delta_mean'])} minutes")
     
 
 st.write('')
@@ -184,10 +250,10 @@ st.write('')
 col1, col2 = st.columns(2)
 
 with col1:
-    st.plotly_chart(pie_eda(df_delay, "state", "State for delayed reservations - due to previous booking"), theme="streamlit", use_container_width=True)
+    st.plotly_chart(charts["delay_state"], theme="streamlit", use_container_width=True)
 
 with col2:
-    st.plotly_chart(pie_eda(df_nodelay, "state", "State for reservations on time - no impact from previous booking"), theme="streamlit", use_container_width=True)
+    st.plotly_chart(charts["nodelay_state"], theme="streamlit", use_container_width=True)
     
 st.write('We can notice that there are more cancellations for reservations which are delayed, we can conclude that waiting time has definitly an impact on the state of the reservation.')
 st.write('')
@@ -199,7 +265,7 @@ st.subheader("Impact of the checkin type from one reservation on the next")
 col1, col2 = st.columns(2)
 
 with col1:
-    st.plotly_chart(display_probability(df_impact, "previous_checkin_type", "waiting_time", "Has the checkin type of the first reservation an impact on the waiting time of the second user ?"), theme="streamlit", use_container_width=True)
+    st.plotly_chart(charts["previous_checkin_type"], theme="streamlit", use_container_width=True)
 
 with col2:
     st.write('')
@@ -218,18 +284,10 @@ st.markdown('---')
 # FOURTH PART TO CHECK IMPACT OF TIME DELTA ON WAITING TIME
 st.subheader('Focus on time delta')
 
-mean_delta = df_impact.groupby(['time_delta', 'previous_checkin_type'])["waiting_time_second_user"].mean().reset_index()
-mean_delta = mean_delta[mean_delta['waiting_time_second_user'] != 0]
-mean_delta['waiting_time_second_user'] = round(mean_delta['waiting_time_second_user'])
-
 col1, col2 = st.columns(2)
 
 with col1:
-    # Calculate the mean waiting time according to the checkin type chosen by the previous user
-    fig1 = px.histogram(mean_delta, x = "time_delta", y = "waiting_time_second_user", color = "previous_checkin_type", histfunc='avg', text_auto=True)
-    # fig = px.bar(mean_delta, x = "time_delta", y = "waiting_time_second_user", color = "previous_checkin_type")
-    fig1.update_layout(title = "Average waiting time regarding time delta and previous checkin type", title_x=0.2)
-    st.plotly_chart(fig1, theme="streamlit", use_container_width=True)
+    st.plotly_chart(charts["mean_delta"], theme="streamlit", use_container_width=True)
     
 with col2:
     st.write('')
@@ -243,7 +301,32 @@ with col2:
 st.markdown('---')
     
 
-# FIFTH PART TO INTRODUCE AN HYPOTHESIS
+# FIFTH PART TO FOLLOW A DELAY DOWN THE CHAIN OF RENTALS
+st.subheader('Delay cascades')
+
+st.markdown("""
+    A late checkout can make the next user wait, who then returns the car late for the following one.
+    Rentals of the same car are followed from one to the next to see how far a delay goes.
+""")
+
+col1, col2, col3, col4 = st.columns(4)
+with col1:
+    st.metric("Chains of consecutive rentals", chain_metrics["chains"])
+    st.write(f"Up to {chain_metrics['chain_size_max']} rentals, {chain_metrics['chain_size_mean']:.1f} on average.")
+with col2:
+    st.metric("Late checkouts making the next users wait", chain_metrics["cascades"])
+    st.write(f"{chain_metrics['multi_hop_cascades']} of them reach a second rental or more.")
+with col3:
+    st.metric("Waiting rentals two hops or more from the late checkout", f"{chain_metrics['multi_hop_share']:.1f}%")
+with col4:
+    st.metric("Total waiting caused by a cascade", f"{round(chain_metrics['downstream_waiting_mean'])} minutes")
+
+st.plotly_chart(cascades_chart, theme="streamlit", use_container_width=True)
+
+st.markdown('---')
+
+
+# SIXTH PART TO INTRODUCE AN HYPOTHESIS
 st.header('Impact of a time delta feature on the waiting time', divider="gray")
 
 st.markdown("""
@@ -252,32 +335,16 @@ st.markdown("""
          - 15 minutes delay after a first reservation with connect checkout.
          """)
 
-st.write(f'The feature has been tested on the {len(df_delay)} reservations which were impacted by waiting time for the second client (over 10 minutes).')
+st.write(f'The feature has been tested on the {metrics["delayed_reservations"]} reservations which were impacted by waiting time for the second client (over 10 minutes).')
 st.write('')
 
-df_hypothesis = df_impact.copy()
-df_hypothesis['new_time_delta'] = df_hypothesis['time_delta']
-df_hypothesis.loc[df_hypothesis['previous_checkin_type'] == 'mobile', 'new_time_delta'] = df_hypothesis.loc[df_hypothesis['previous_checkin_type'] == 'mobile', 'new_time_delta'].apply(lambda x: 90 if x < 90 else x)
-df_hypothesis.loc[df_hypothesis['previous_checkin_type'] == 'connect', 'new_time_delta'] = df_hypothesis.loc[df_hypothesis['previous_checkin_type'] == 'connect', 'new_time_delta'].apply(lambda x: 15 if x < 15 else x)
-
-# Calculate the new waiting time 
-df_hypothesis['test_waiting_time_second_user'] = df_hypothesis['previous_delay_in_minutes'] - df_hypothesis['new_time_delta']
-
-# 0 for all lines where the car is ontime for the second user
-df_hypothesis['test_waiting_time_second_user'] = df_hypothesis['test_waiting_time_second_user'].apply(lambda x: 0 if x <= 0 else x)
-
-# Create a simple column to have the information if the 2nd user had to wait for the car (considering delay as 10 minutes late)
-df_hypothesis['test_waiting_time'] = df_hypothesis['test_waiting_time_second_user'].apply(lambda x: "late" if x > 10 else "on time") 
-
-
-# Calculate proportion of delayed reservations
-late_real = round((df_hypothesis['waiting_time'].value_counts(normalize=True)*100)[0])
-late_hypothesis = round((df_hypothesis['test_waiting_time'].value_counts(normalize=True)*100)[1])
+# Minimum delay of 90 minutes after a mobile checkin, 15 after a connect one (see analytics.hypothesis_frame)
+# Proportion of delayed reservations
+late_hypothesis = round(metrics["late_hypothesis"])
 
 # New waiting time
-df_hypothesis_delay = df_hypothesis[df_hypothesis["waiting_time"] == "yes"]
-mean_hypothesis = round(df_hypothesis_delay['test_waiting_time_second_user'].mean())
-delay_mean = round(df_delay['waiting_time_second_user'].mean())
+mean_hypothesis = round(metrics["mean_hypothesis"])
+delay_mean = round(metrics["delay_mean"])
 
 
 col1, col2 = st.columns(2)
@@ -297,6 +364,50 @@ with col2 :
     
 
 st.write('')
+
+# Every pair of thresholds is precomputed (analytics.threshold_grid), moving a slider is a lookup
+st.subheader("Threshold simulator")
+grid = analytics["threshold_grid"]
+col1, col2 = st.columns(2)
+with col1:
+    mobile_threshold = st.select_slider("Minimum delay after a mobile checkin (minutes)", options=[int(t) for t in grid["mobile_thresholds"]], value=90)
+with col2:
+    connect_threshold = st.select_slider("Minimum delay after a connect checkin (minutes)", options=[int(t) for t in grid["connect_thresholds"]], value=15)
+
+scenario = lookup(grid, mobile_threshold, connect_threshold)
+baseline = lookup(grid, 0, 0)
+col1, col2, col3 = st.columns(3)
+with col1:
+    st.metric("Proportion of delayed reservations", f"{scenario['late_share']:.1f}%", delta=f"{scenario['late_share'] - baseline['late_share']:.1f} pts", delta_color="inverse")
+with col2:
+    st.metric("Average waiting time of the delayed reservations", f"{round(scenario['mean_waiting'])} minutes", delta=f"{round(scenario['mean_waiting'] - baseline['mean_waiting'])} minutes", delta_color="inverse")
+with col3:
+    st.metric("Rentals blocked by the minimum delay", f"{int(scenario['blocked'])}", delta=f"{scenario['blocked'] / max(metrics['relevant_reservations'], 1) * 100:.1f}% of the relevant reservations", delta_color="off")
+
+# Revenue of the rentals in the delay analysis, priced with the pricing model
+cell = lookup_index(revenue, mobile_threshold, connect_threshold)
+at_risk, recovered = float(revenue["at_risk"][cell]), float(revenue["recovered"][cell])
+col1, col2, col3 = st.columns(3)
+with col1:
+    st.metric("Revenue at risk - rentals blocked", f"{at_risk:,.0f} €")
+with col2:
+    st.metric("Revenue of the cancellations avoided", f"{recovered:,.0f} €", delta=f"out of {revenue['lost_to_waiting']:,.0f} € cancelled after waiting", delta_color="off")
+with col3:
+    st.metric("Net revenue at risk", f"{at_risk - recovered:,.0f} €")
+if prices_warning:
+    st.warning(prices_warning)
+st.caption(f"Prices: {'observed prices of the fleet' if prices_source == 'observed' else 'pricing model ' + prices_source}, "
+           f"{revenue['mean_price']:.0f} € per day on average. The rentals aren't linked to the cars of the fleet, "
+           "each one is priced with the average price of the cars with the same checkin equipment, for one day.")
+
+fig = go.Figure(go.Heatmap(
+    z=grid["late_share"], x=grid["connect_thresholds"], y=grid["mobile_thresholds"],
+    colorbar=dict(title="% delayed"), hovertemplate="mobile %{y} min, connect %{x} min: %{z:.1f}% delayed<extra></extra>"
+))
+fig.add_trace(go.Scatter(x=[connect_threshold], y=[mobile_threshold], mode="markers", marker=dict(color="white", size=12, symbol="x"), showlegend=False, hoverinfo="skip"))
+fig.update_layout(title="Proportion of delayed reservations by minimum delay", title_x=0.3, xaxis_title="connect (minutes)", yaxis_title="mobile (minutes)")
+st.plotly_chart(fig, theme="streamlit", use_container_width=True)
+
 st.write('')
 st.write('')
 
@@ -0,0 +1,139 @@
+"""
+Rental chains: consecutive rentals of the same car, linked through `previous_ended_rental_id`.
+
+The dashboard otherwise looks one hop back. Here a late checkout is followed down the chain:
+the next user waits, returns the car late in turn, the one after waits too...
+
+* `link` sorts the rentals by (car, rental) once and finds each predecessor with a binary search
+  (a car never links to another car's rental), the first successor and the successor count follow
+* `pointer_jump` gives the root of every rental and its depth in O(n log depth)
+* `subtree_sums` accumulates values from the leaves to the roots, one depth level at a time
+
+A rental a rental waited for (at least `WAITING_THRESHOLD` minutes, see analytics.py) hangs under
+it in the cascade forest: the rentals under a late checkout are the ones its delay reached.
+"""
+import numpy as np
+import pandas as pd
+
+from analytics import MAX_DELAY, WAITING_THRESHOLD, floats, waiting_time
+
+
+def link(car_ids, rental_ids, previous_rental_ids):
+    """
+    Order of the rentals by (car, rental) and, in that order, the position of the predecessor
+    and of the first successor of each rental (-1 if none) and its number of successors.
+    """
+    car_codes, cars = pd.factorize(np.asarray(car_ids))
+    rental_ids = np.asarray(rental_ids, dtype=np.int64)
+    previous = floats(previous_rental_ids)
+    # One int64 key per (car, rental), so a predecessor is searched among the rentals of the same car
+    stride = int(max(rental_ids.max(initial=0), np.nanmax(previous, initial=0))) + 1
+    if len(cars) * stride >= 2 ** 63:
+        raise ValueError("rental ids too large to build the chain keys")
+    keys = car_codes.astype(np.int64) * stride + rental_ids
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    previous = previous[order]
+    car_codes = car_codes[order]
+
+    predecessor = np.full(len(keys), -1, dtype=np.int64)
+    known = ~np.isnan(previous)
+    wanted = car_codes[known].astype(np.int64) * stride + previous[known].astype(np.int64)
+    found = np.searchsorted(keys, wanted)
+    hit = found < len(keys)
+    hit[hit] = keys[found[hit]] == wanted[hit]
+    predecessor[np.flatnonzero(known)[hit]] = found[hit]
+
+    successors = np.bincount(predecessor[predecessor >= 0], minlength=len(keys))
+    successor = np.full(len(keys), -1, dtype=np.int64)
+    linked = np.flatnonzero(predecessor >= 0)
+    # Rows are in rental order, the first occurrence of a predecessor is its first successor
+    parents, first = np.unique(predecessor[linked], return_index=True)
+    successor[parents] = linked[first]
+    return order, predecessor, successor, successors
+
+
+def pointer_jump(parent):
+    """Root and depth (number of hops to the root) of each node of a forest, -1 meaning no parent."""
+    n = len(parent)
+    has_parent = parent >= 0
+    root = np.where(has_parent, parent, np.arange(n))
+    depth = has_parent.astype(np.int64)
+    # Each round doubles the distance jumped: log2(longest chain) rounds
+    for _ in range(max(n, 1).bit_length() + 1):
+        ancestor = root[root]
+        if np.array_equal(ancestor, root):
+            return root, depth
+        depth = depth + depth[root]
+        root = ancestor
+    raise ValueError("the rentals form a cycle")
+
+
+def subtree_sums(parent, depth, values):
+    """Sum of `values` over the descendants of each node (itself excluded), deepest level first."""
+    totals = np.zeros(len(parent), dtype=np.float64)
+    carried = np.asarray(values, dtype=np.float64).copy()
+    by_depth = np.argsort(depth, kind="stable")
+    bounds = np.searchsorted(depth[by_depth], np.arange(depth.max(initial=0), 0, -1))
+    end = len(by_depth)
+    for start in bounds:
+        nodes = by_depth[start:end]
+        np.add.at(totals, parent[nodes], carried[nodes])
+        np.add.at(carried, parent[nodes], carried[nodes])
+        end = start
+    return totals
+
+
+def chain_frame(df):
+    """
+    One row per rental, ordered by car and rental, with its chain (`chain_root` rental id, `chain_size`
+    rentals, `chain_depth` hops from the root) and its cascade: `waiting` for the previous car,
+    `cascade_origin` (the late checkout the delay comes from), `cascade_hops` from it, and how many
+    `downstream_rentals` waited because of it and for how long (`downstream_waiting`).
+    """
+    order, predecessor, successor, successors = link(df['car_id'], df['rental_id'], df['previous_ended_rental_id'])
+    chains = df.iloc[order][['rental_id', 'car_id', 'state', 'checkin_type', 'is_late', 'delay_in_minutes', 'time_delta', 'previous_delay_in_minutes']].reset_index(drop=True)
+    rental_ids = chains['rental_id'].to_numpy()
+    chains['previous_rental'] = np.where(predecessor >= 0, rental_ids[predecessor], -1)
+    chains['next_rental'] = np.where(successor >= 0, rental_ids[successor], -1)
+    chains['successors'] = successors
+
+    root, depth = pointer_jump(predecessor)
+    chains['chain_root'] = rental_ids[root]
+    chains['chain_depth'] = depth
+    chains['chain_size'] = np.bincount(root, minlength=len(root))[root]
+
+    previous_delay = floats(chains['previous_delay_in_minutes'])
+    waiting = np.nan_to_num(waiting_time(previous_delay, chains['time_delta']))
+    # Same rules as the one-hop analysis: outliers left out, waiting from 10 minutes
+    waited = (predecessor >= 0) & (np.abs(previous_delay) <= MAX_DELAY) & (waiting >= WAITING_THRESHOLD)
+    chains['waiting'] = np.where(waited, waiting, 0.0)
+    cascade_parent = np.where(waited, predecessor, -1)
+    origin, hops = pointer_jump(cascade_parent)
+    chains['cascade_origin'] = rental_ids[origin]
+    chains['cascade_hops'] = hops
+    chains['downstream_rentals'] = subtree_sums(cascade_parent, hops, waited).astype(np.int64)
+    chains['downstream_waiting'] = subtree_sums(cascade_parent, hops, chains['waiting'])
+    return chains
+
+
+def cascade_metrics(chains):
+    """Headline numbers of the chains and of the cascades started by late checkouts."""
+    late = chains['is_late'].to_numpy() == "checkout late"
+    roots = chains['chain_depth'].to_numpy() == 0
+    chain_sizes = chains.loc[roots, 'chain_size']
+    origins = chains[(chains['cascade_hops'] == 0) & (chains['downstream_rentals'] > 0)]
+    waited = chains['cascade_hops'].to_numpy() > 0
+    affected = chains.loc[late, 'downstream_rentals']
+    return {
+        "chains": int((chain_sizes > 1).sum()),
+        "chain_size_mean": float(chain_sizes[chain_sizes > 1].mean()) if (chain_sizes > 1).any() else 0.0,
+        "chain_size_max": int(chain_sizes.max()) if len(chain_sizes) else 0,
+        "cascades": len(origins),
+        "multi_hop_cascades": int((origins['rental_id'].isin(chains.loc[chains['cascade_hops'] > 1, 'cascade_origin'])).sum()),
+        "multi_hop_share": float((chains['cascade_hops'] > 1).sum() / max(int(waited.sum()), 1) * 100),
+        "cascade_hops_max": int(chains['cascade_hops'].max()) if len(chains) else 0,
+        "downstream_waiting_mean": float(origins['downstream_waiting'].mean()) if len(origins) else 0.0,
+        "affected_per_late_checkout": float(affected.mean()) if len(affected) else 0.0,
+        "affected_max": int(affected.max()) if len(affected) else 0,
+    }
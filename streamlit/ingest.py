@@ -0,0 +1,74 @@
+"""
+Converts the dashboard inputs into a local, typed columnar store the dashboard memory-maps:
+
+* `df.csv` (delay analysis) -> `STORE_DIR/rentals.arrow`
+* the pricing project csv (fleet) -> `STORE_DIR/fleet.arrow`
+
+Text columns become categoricals (Arrow dictionaries) and integer columns with missing values
+nullable integers (Int64). The files are uncompressed Arrow IPC, so the dashboard maps them
+instead of parsing csv and fetching the fleet over HTTP on every cold start.
+
+    python ingest.py
+    python ingest.py --rentals df.csv --fleet get_around_pricing_project.csv
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STORE_DIR = os.environ.get("STORE_DIR", os.path.join(HERE, "store"))
+RENTALS_CSV = os.path.join(HERE, "df.csv")
+FLEET_CSV = os.environ.get("FLEET_CSV", "https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv")
+
+
+def typed(df):
+    """Text columns as categoricals, integral float columns (ints with missing values) as Int64."""
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object or str(values.dtype) in ("str", "string"):
+            df[column] = values.astype("category")
+        elif values.dtype.kind == "f":
+            present = values.dropna().to_numpy()
+            if np.array_equal(present, np.round(present)) and (len(present) == 0 or np.abs(present).max() < 2 ** 53):
+                df[column] = values.astype("Int64")
+    return df
+
+
+def write_store(df, path):
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_store(path):
+    """DataFrame of a store file, memory-mapped (numeric columns without missing values aren't copied)."""
+    import pyarrow as pa
+
+    # The map stays open as long as the arrays pointing into it are alive
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas(split_blocks=True)
+
+
+def ingest(rentals=RENTALS_CSV, fleet=FLEET_CSV, store_dir=STORE_DIR):
+    os.makedirs(store_dir, exist_ok=True)
+    paths = {}
+    for name, source, options in (("rentals", rentals, {}), ("fleet", fleet, {"index_col": 0})):
+        df = typed(pd.read_csv(source, **options))
+        paths[name] = write_store(df, os.path.join(store_dir, f"{name}.arrow"))
+        print(f"{source}: {len(df)} rows -> {paths[name]}")
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the dashboard inputs into the local Arrow store")
+    parser.add_argument("--rentals", default=RENTALS_CSV, help="Delay analysis csv")
+    parser.add_argument("--fleet", default=FLEET_CSV, help="Pricing project csv (path or url)")
+    parser.add_argument("--store-dir", default=STORE_DIR)
+    args = parser.parse_args()
+    ingest(args.rentals, args.fleet, args.store_dir)
@@ -0,0 +1,211 @@
+"""
+Revenue at risk of the minimum delay between rentals.
+
+1. At ingest time (`python revenue.py`, after `python ingest.py`), the fleet
+   (`get_around_pricing_project.csv`) is scored in-process with the pricing pipeline trained by
+   `machine_learning/train.py`, `chunksize` cars at a time (no `/predict` round trips). The prices
+   are stored next to the Arrow store (`prices_<model version>.arrow`, a model version is only
+   scored once) and `prices.json` points the dashboard at the current ones: the dashboard reads
+   them, it never contacts the registry nor needs mlflow.
+2. The delay analysis has no link to the cars of the fleet (its `car_id`s aren't in the pricing
+   file), so a rental is priced with the average predicted price of the fleet cars with the same
+   checkin equipment (`has_getaround_connect`), the fleet average otherwise. A fleet with a
+   `car_id` column is joined on it instead.
+3. For every (mobile, connect) pair of `analytics.THRESHOLDS`: the revenue of the rentals the
+   minimum delay blocks (at risk) and of the rentals cancelled after waiting that it would have
+   saved (recovered).
+
+Without scored prices (or when they were scored for another fleet), the dashboard uses the
+observed `rental_price_per_day` of the fleet and says so.
+
+    python revenue.py                         # score the fleet with the current model (needs mlflow)
+    python revenue.py --model runs:/<run_id>/getaround_project
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from analytics import THRESHOLDS, WAITING_THRESHOLD, floats, waiting_time
+from ingest import FLEET_CSV, STORE_DIR, read_store, write_store
+
+PRICING_MODEL_URI = os.environ.get("PRICING_MODEL_URI", "models:/api_linear_regression/latest")
+# Rentals last one day by default (the delay analysis doesn't record their duration)
+RENTAL_DAYS = float(os.environ.get("RENTAL_DAYS", 1))
+TARGET = "rental_price_per_day"
+BOOLEAN_FEATURES = ['private_parking_available', 'has_gps', 'has_air_conditioning', 'automatic_car',
+                    'has_getaround_connect', 'has_speed_regulator', 'winter_tires']
+
+
+def model_version(uri):
+    """Version of a models:/ uri (`latest` resolved through the registry), the run id of a runs:/ uri."""
+    if uri.startswith("models:/"):
+        name, _, version = uri[len("models:/"):].partition("/")
+        if version in ("", "latest"):
+            from mlflow.tracking import MlflowClient
+
+            versions = MlflowClient().search_model_versions(f"name='{name}'")
+            if not versions:
+                raise LookupError(f"No version registered under {name!r}")
+            version = max(versions, key=lambda v: int(v.version)).version
+        return f"{name}-{version}", f"models:/{name}/{version}"
+    if uri.startswith("runs:/"):
+        return uri[len("runs:/"):].split("/")[0], uri
+    return os.path.basename(os.path.normpath(uri)), uri
+
+
+def features(fleet):
+    """
+    Pricing features of the fleet, as the model was trained on them: boolean features as "yes" / "no"
+    like the API sends them, text columns as str (the store's categoricals don't pass the model signature).
+    """
+    X = fleet.drop(columns=[TARGET, "Unnamed: 0"], errors="ignore").copy()
+    for column in X.columns:
+        if column in BOOLEAN_FEATURES:
+            X[column] = np.where(X[column].isin([True, "True", "true", "yes"]), "yes", "no").astype(object)
+        elif isinstance(X[column].dtype, pd.CategoricalDtype):
+            X[column] = X[column].astype(object)
+    return X
+
+
+def score_fleet(model, fleet, chunksize=50000):
+    """Predicted price per day of every car, `chunksize` rows per `model.predict` call."""
+    X = features(fleet)
+    prices = np.empty(len(X), dtype=np.float64)
+    for start in range(0, len(X), chunksize):
+        prices[start:start + chunksize] = np.ravel(model.predict(X.iloc[start:start + chunksize]))
+    return prices
+
+
+def fleet_hash(fleet):
+    """Hash of the pricing features, prices scored for another fleet aren't used."""
+    hashes = pd.util.hash_pandas_object(features(fleet), index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+def prices_index_path(store_dir=STORE_DIR):
+    return os.path.join(store_dir, "prices.json")
+
+
+def score(fleet, model_uri=PRICING_MODEL_URI, store_dir=STORE_DIR):
+    """
+    Score the fleet with the model at `model_uri` (unless this version already scored this fleet),
+    store the prices and point `prices.json` at them. Returns the index entry.
+    """
+    import mlflow
+
+    version, uri = model_version(model_uri)
+    path = os.path.join(store_dir, f"prices_{version}.arrow")
+    fleet_sha256 = fleet_hash(fleet)
+    index_path = prices_index_path(store_dir)
+    try:
+        with open(index_path) as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        entry = {}
+    if not (entry.get("version") == version and entry.get("fleet_sha256") == fleet_sha256 and os.path.exists(path)):
+        prices = score_fleet(mlflow.pyfunc.load_model(uri), fleet)
+        os.makedirs(store_dir, exist_ok=True)
+        write_store(pd.DataFrame({"price": prices}), path)
+        entry = {"version": version, "model_uri": uri, "file": os.path.basename(path),
+                 "cars": len(prices), "fleet_sha256": fleet_sha256, "scored_at": time.time()}
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, index_path)
+    return entry
+
+
+def fleet_prices(fleet, store_dir=STORE_DIR):
+    """
+    (prices, source, warning): prices stored by `score` and the model version they come from.
+    The observed prices, and why, when there are none for this fleet. Reads local files only.
+    """
+    try:
+        with open(prices_index_path(store_dir)) as f:
+            entry = json.load(f)
+        if entry["fleet_sha256"] != fleet_hash(fleet):
+            raise LookupError(f"the prices of {entry['version']} were scored for another fleet")
+        prices = floats(read_store(os.path.join(store_dir, entry["file"]))["price"])
+    except FileNotFoundError:
+        return floats(fleet[TARGET]), "observed", "The fleet hasn't been scored with the pricing model (`python revenue.py`), using the observed prices"
+    except Exception as e:
+        return floats(fleet[TARGET]), "observed", f"Stored prices unavailable ({e}), using the observed prices"
+    return prices, entry["version"], None
+
+
+def rental_prices(rentals, fleet, prices):
+    """Price per day of each rental: its car's when the fleet has `car_id`s, else the average of similar cars."""
+    average = float(np.mean(prices)) if len(prices) else 0.0
+    if "car_id" in fleet:
+        by_car = pd.Series(prices, index=fleet["car_id"].to_numpy()).groupby(level=0).mean()
+        matched = rentals["car_id"].map(by_car)
+        return matched.to_numpy(dtype=np.float64, na_value=np.nan)
+    # Connect checkins need the Getaround Connect equipment
+    by_equipment = pd.Series(prices).groupby(features(fleet)["has_getaround_connect"].to_numpy()).mean()
+    per_checkin = {"connect": by_equipment.get("yes", average), "mobile": by_equipment.get("no", average)}
+    return rentals["checkin_type"].astype(object).map(per_checkin).fillna(average).to_numpy(dtype=np.float64)
+
+
+def _revenue_sums(previous_delay, time_delta, revenue, cancelled, thresholds, chunksize=65536):
+    """For each threshold: revenue of the rentals blocked, and of the cancelled ones that wouldn't wait anymore."""
+    blocked = np.zeros(len(thresholds))
+    recovered = np.zeros(len(thresholds))
+    for start in range(0, len(previous_delay), chunksize):
+        delay = previous_delay[start:start + chunksize, None]
+        delta = time_delta[start:start + chunksize, None]
+        rows_revenue = revenue[start:start + chunksize, None]
+        blocked += np.where(delta < thresholds[None, :], rows_revenue, 0).sum(axis=0)
+        was_waiting = waiting_time(delay, delta) >= WAITING_THRESHOLD
+        waiting = waiting_time(delay, np.maximum(delta, thresholds[None, :]))
+        saved = cancelled[start:start + chunksize, None] & was_waiting & (waiting < WAITING_THRESHOLD)
+        recovered += np.where(saved, rows_revenue, 0).sum(axis=0)
+    return blocked, recovered
+
+
+def revenue_grid(df_impact, fleet, prices, mobile_thresholds=THRESHOLDS, connect_thresholds=THRESHOLDS, rental_days=RENTAL_DAYS):
+    """
+    Revenue at risk / recovered of every (mobile, connect) pair of minimum delays, laid out like
+    `analytics.threshold_grid` (cell [i, j] is mobile_thresholds[i] x connect_thresholds[j]).
+    """
+    mobile_thresholds = np.asarray(mobile_thresholds, dtype=np.float64)
+    connect_thresholds = np.asarray(connect_thresholds, dtype=np.float64)
+    revenue = np.nan_to_num(rental_prices(df_impact, fleet, prices), nan=float(np.mean(prices)) if len(prices) else 0.0) * rental_days
+    previous_delay = floats(df_impact['previous_delay_in_minutes'])
+    time_delta = floats(df_impact['time_delta'])
+    previous_checkin = df_impact['previous_checkin_type'].to_numpy(dtype=object)
+    cancelled = df_impact['state'].to_numpy(dtype=object) == "canceled"
+
+    sums = {}
+    for checkin_type, thresholds in (("mobile", mobile_thresholds), ("connect", connect_thresholds)):
+        rows = previous_checkin == checkin_type
+        sums[checkin_type] = _revenue_sums(previous_delay[rows], time_delta[rows], revenue[rows], cancelled[rows], thresholds)
+    (mobile_blocked, mobile_recovered), (connect_blocked, connect_recovered) = sums["mobile"], sums["connect"]
+    at_risk = mobile_blocked[:, None] + connect_blocked[None, :]
+    recovered = mobile_recovered[:, None] + connect_recovered[None, :]
+    return {
+        "mobile_thresholds": mobile_thresholds,
+        "connect_thresholds": connect_thresholds,
+        "at_risk": at_risk,
+        "recovered": recovered,
+        "net": at_risk - recovered,
+        "lost_to_waiting": float(revenue[cancelled & (waiting_time(previous_delay, time_delta) >= WAITING_THRESHOLD)].sum()),
+        "mean_price": float(np.mean(prices)) if len(prices) else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the fleet with the pricing model and store the prices")
+    parser.add_argument("--model", default=PRICING_MODEL_URI, help="Pricing model uri (models:/, runs:/ or local path)")
+    parser.add_argument("--fleet", default=FLEET_CSV, help="Pricing project csv (path or url)")
+    parser.add_argument("--store-dir", default=STORE_DIR)
+    args = parser.parse_args()
+    fleet_path = os.path.join(args.store_dir, "fleet.arrow")
+    fleet = read_store(fleet_path) if os.path.exists(fleet_path) else pd.read_csv(args.fleet, index_col=0)
+    entry = score(fleet, args.model, args.store_dir)
+    prices, source, _ = fleet_prices(fleet, args.store_dir)
+    print(f"{len(prices)} cars priced with {source}, {np.mean(prices):.1f} per day on average -> {os.path.join(args.store_dir, entry['file'])}")
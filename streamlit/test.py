@@ -0,0 +1,66 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#### Test revenue scoring
+def test_score_ingested_fleet():
+    import mlflow
+    from mlflow.models import infer_signature
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+    from ingest import read_store, typed, write_store
+    from revenue import features, fleet_prices, score
+
+    # Sample cars of the API tests with a made up price
+    fleet = pd.read_csv(os.path.join(HERE, "..", "api", "data", "test_data.csv"))
+    fleet["rental_price_per_day"] = 20 + fleet["engine_power"] * 0.8 - fleet["mileage"] // 5000
+
+    # Same pipeline and signature (string columns) as machine_learning/train.py
+    X = features(fleet)
+    numeric_features = ["mileage", "engine_power"]
+    categorical_features = [col for col in X.columns if col not in numeric_features]
+    model = Pipeline(steps=[
+        ("Preprocessing", ColumnTransformer(transformers=[
+            ("num", StandardScaler(), numeric_features),
+            ("cat", OneHotEncoder(drop='first', handle_unknown='ignore'), categorical_features),
+        ])),
+        ("Regressor", LinearRegression())
+    ])
+    model.fit(X, fleet["rental_price_per_day"])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = os.path.join(tmp, "model")
+        mlflow.sklearn.save_model(model, model_path, serialization_format=mlflow.sklearn.SERIALIZATION_FORMAT_CLOUDPICKLE,
+                                  signature=infer_signature(X, model.predict(X)))
+
+        # The fleet as the dashboard reads it: text columns as categoricals
+        write_store(typed(fleet.copy()), os.path.join(tmp, "fleet.arrow"))
+        stored = read_store(os.path.join(tmp, "fleet.arrow"))
+        assert any(isinstance(dtype, pd.CategoricalDtype) for dtype in stored.dtypes)
+
+        # Nothing scored yet: observed prices
+        prices, source, warning = fleet_prices(stored, tmp)
+        assert source == "observed" and warning
+        np.testing.assert_allclose(prices, fleet["rental_price_per_day"])
+
+        # Scored at ingest time, read back by the dashboard (from the store or from the csv)
+        entry = score(stored, model_path, tmp)
+        for loaded in (stored, fleet):
+            prices, source, warning = fleet_prices(loaded, tmp)
+            assert warning is None and source == entry["version"], warning
+            np.testing.assert_allclose(prices, model.predict(X), rtol=1e-9, atol=1e-6)
+
+        # Prices scored for another fleet aren't used
+        other = stored.assign(mileage=stored["mileage"] + 1)
+        prices, source, warning = fleet_prices(other, tmp)
+        assert source == "observed" and warning
+    print("Ingested fleet scored with the pricing model")
+
+
+if __name__ == "__main__":
+    test_score_ingested_fleet()